@@ -4,81 +4,1763 @@ from ebooklib import epub
 from bs4 import BeautifulSoup
 from PIL import Image, ImageTk
 import io
+import copy
+import mmap
 import os
 import posixpath
+import sys
 import html
 import requests
+import urllib3
+import random
 import threading
 import ebooklib
 import time
 import webbrowser
 import urllib.parse
-import queue
 from ttkthemes import ThemedTk
 import datetime
 import re
+import unicodedata
+import json
 import gc
 import concurrent.futures
 import functools
+import bisect
 import hashlib
-import weakref
+import sqlite3
+import struct
+import zipfile
+import zlib
+import marshal
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, namedtuple, deque
+
+# 用于在原始HTML中快速提取标题，避免为每个章节构建完整的DOM树
+TITLE_PATTERNS = [
+    re.compile(rb'<title[^>]*>(.*?)</title>', re.S | re.I),
+    re.compile(rb'<h1[^>]*>(.*?)</h1>', re.S | re.I),
+    re.compile(rb'<h2[^>]*>(.*?)</h2>', re.S | re.I),
+]
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+def extract_html_title(content):
+    """从HTML原始字节中提取标题 - 不解析整个文档"""
+    for pattern in TITLE_PATTERNS:
+        match = pattern.search(content)
+        if match:
+            text = match.group(1).decode('utf-8', errors='ignore')
+            return html.unescape(TAG_PATTERN.sub('', text)).strip()
+    return None
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
 # 缓存装饰器，用于缓存耗时操作的结果
-def memoize(maxsize=128):
+# maxsize: 最多缓存的结果数；ttl: 结果有效期（秒），None表示不过期；
+# key: 自定义缓存键函数，接收与被装饰函数相同的参数
+def memoize(maxsize=128, ttl=None, key=None):
+    """线程安全的LRU缓存装饰器"""
     def decorator(func):
-        cache = {}
+        cache = OrderedDict()  # key -> (result, timestamp)
+        lock = threading.Lock()
+        stats = {"hits": 0, "misses": 0}
         
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            key = (args, tuple(sorted(kwargs.items())))
+            try:
+                if key is not None:
+                    cache_key = key(*args, **kwargs)
+                else:
+                    cache_key = (args, tuple(sorted(kwargs.items())))
+                hash(cache_key)
+            except TypeError:
+                # 参数不可哈希时直接调用
+                return func(*args, **kwargs)
             
-            # 使用弱引用避免内存泄漏
-            if key in cache:
-                result = cache[key]()
-                if result is not None:
-                    return result
+            with lock:
+                entry = cache.get(cache_key)
+                if entry is not None:
+                    result, timestamp = entry
+                    if ttl is None or time.monotonic() - timestamp < ttl:
+                        cache.move_to_end(cache_key)
+                        stats["hits"] += 1
+                        return result
+                    del cache[cache_key]
+                stats["misses"] += 1
             
+            # 在锁外计算，避免阻塞其他线程
             result = func(*args, **kwargs)
-            if len(cache) >= maxsize:
-                cache.popitem(last=False)
             
-            # 使用弱引用存储结果
-            cache[key] = weakref.ref(result)
+            with lock:
+                cache[cache_key] = (result, time.monotonic())
+                cache.move_to_end(cache_key)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
             return result
         
+        def cache_info():
+            with lock:
+                return CacheInfo(stats["hits"], stats["misses"], maxsize, len(cache))
+        
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats["hits"] = stats["misses"] = 0
+        
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
         return wrapper
     return decorator
 
-# 图像缓存类
-class ImageCache:
-    def __init__(self, max_size=50):
-        self.cache = {}
-        self.max_size = max_size
-        self.access_counter = {}
-        self.counter = 0
-        
-    def get(self, key, chapter_dir, text_width):
-        # 生成复合键，包含文本宽度以适应不同尺寸
-        composite_key = (key, text_width)
-        
-        if composite_key in self.cache:
-            self.access_counter[composite_key] = self.counter
-            self.counter += 1
-            return self.cache[composite_key]
+def format_size(size):
+    """转换文件大小为易读的字符串"""
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size/1024:.1f} KB"
+    else:
+        return f"{size/(1024*1024):.1f} MB"
+
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+
+def normalize_title(text):
+    """标准化书名用于搜索：统一全半角和大小写，标点替换为空格"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return NON_WORD_PATTERN.sub(" ", text).strip()
+
+# 远程书籍列表的过滤索引：预先标准化书名，支持前缀、分词和模糊匹配，结果按匹配程度排序
+class BookFilterIndex:
+    def __init__(self, names):
+        self.names = list(names)
+        self.entries = [(name, normalize_title(os.path.splitext(name)[0])) for name in self.names]
+        self.last_query = None
+        self.last_matches = None
+        
+    def match(self, query):
+        """返回匹配的书名列表：按匹配程度排序，相同程度保持原有顺序；
+        没有子串匹配时才返回模糊匹配的结果，首字母匹配优先"""
+        query = normalize_title(query)
+        if not query:
+            self.last_query = None
+            return list(self.names)
+            
+        # 继续输入时候选只会减少，只需在上一次的候选中筛选
+        if self.last_query is not None and query.startswith(self.last_query):
+            candidates = self.last_matches
+        else:
+            candidates = self.entries
+            
+        # 候选：每个词都是书名的子串，或整个关键词按顺序出现在书名中（模糊匹配，如 "hp" 匹配 "harry potter"）
+        tokens = query.split()
+        fuzzy = re.compile(".*?".join(map(re.escape, query.replace(" ", ""))))
+        matches = [entry for entry in candidates
+                   if all(token in entry[1] for token in tokens) or fuzzy.search(entry[1])]
+        
+        self.last_query = query
+        self.last_matches = matches
+        
+        ranked = []
+        for position, (name, title) in enumerate(matches):
+            rank = self.rank(query, tokens, title)
+            if rank is not None:
+                ranked.append((rank, position, name))
+        if ranked:
+            return [name for _, _, name in sorted(ranked)]
+        # 只有模糊匹配时，关键词按顺序出现在各词首字母中的（如 "hp"）排在前面
+        initials = [(0 if fuzzy.search("".join(word[0] for word in title.split())) else 1, position, name)
+                    for position, (name, title) in enumerate(matches)]
+        return [name for _, _, name in sorted(initials)]
+        
+    @staticmethod
+    def rank(query, tokens, title):
+        """匹配程度，越小越靠前：书名前缀、词首子串、其他子串、各个词分别出现；只能模糊匹配时返回None"""
+        if title.startswith(query):
+            return 0
+        if " " + query in title:
+            return 1
+        if query in title:
+            return 2
+        if all(token in title for token in tokens):
+            return 3
         return None
+
+# 虚拟列表：Treeview中只保留一页（滑动窗口）的行，滚动到窗口边缘时换入相邻的行
+# 数据更新时只对窗口内变化的行执行删除、插入、移动或修改，滚动条按全部数据显示位置
+class VirtualTreeview:
+    def __init__(self, tree, scrollbar, page_size=200):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.page_size = page_size
+        self.rows = []  # 全部行 [(行ID, 值)]
+        self.values = {}  # 行ID -> 值
+        self.start = 0  # 窗口第一行在全部数据中的位置
+        self.window = []  # 当前在Treeview中的行ID
+        self.shown_values = {}  # Treeview中各行当前显示的值
+        self.selected = set()  # 选中的行ID（包括已移出窗口的行）
+        self.sliding = False
+        tree.configure(yscrollcommand=self.on_tree_scroll)
+        scrollbar.configure(command=self.yview)
+        tree.bind("<<TreeviewSelect>>", self.on_select, add="+")
+        
+    def set_rows(self, rows, reset_position=False):
+        """替换全部数据，只更新窗口内变化的行"""
+        self.rows = list(rows)
+        self.values = dict(self.rows)
+        self.selected &= self.values.keys()
+        self.show_window(0 if reset_position else self.start)
+        if reset_position:
+            self.tree.yview_moveto(0)
+            
+    def selection(self):
+        """按列表顺序返回选中的行ID"""
+        self.on_select()
+        return tuple(iid for iid, _ in self.rows if iid in self.selected)
+        
+    def on_select(self, event=None):
+        # 窗口外的选中状态保持不变
+        window = set(self.window)
+        self.selected = {iid for iid in self.selected if iid not in window} | set(self.tree.selection())
+        
+    def show_window(self, start):
+        """移动窗口到start位置，对Treeview应用差异"""
+        sliding, self.sliding = self.sliding, True
+        try:
+            self.apply_window(start)
+        finally:
+            self.sliding = sliding
+            
+    def apply_window(self, start):
+        self.start = max(0, min(start, len(self.rows) - self.page_size))
+        wanted = [iid for iid, _ in self.rows[self.start:self.start + self.page_size]]
+        wanted_set = set(wanted)
+        
+        removed = [iid for iid in self.window if iid not in wanted_set]
+        if removed:
+            self.tree.delete(*removed)
+            for iid in removed:
+                del self.shown_values[iid]
+        current = [iid for iid in self.window if iid in wanted_set]
+        shown = set(current)
+        
+        restore = []
+        for index, iid in enumerate(wanted):
+            values = self.values[iid]
+            if iid in shown:
+                if current[index] != iid:
+                    self.tree.move(iid, "", index)
+                    current.remove(iid)
+                    current.insert(index, iid)
+                if self.shown_values[iid] != values:
+                    self.tree.item(iid, values=values)
+            else:
+                self.tree.insert("", index, iid=iid, values=values)
+                current.insert(index, iid)
+                if iid in self.selected:
+                    restore.append(iid)
+            self.shown_values[iid] = values
+        self.window = wanted
+        if restore:
+            self.tree.selection_add(*restore)
+            
+    def on_tree_scroll(self, first, last):
+        """Treeview视图变化时更新滚动条，到达窗口边缘时滑动窗口"""
+        first, last = float(first), float(last)
+        count = len(self.window)
+        if not self.sliding and count:
+            step = self.page_size // 2
+            if last >= 1.0 and self.start + count < len(self.rows):
+                self.slide(step, first, last)
+                return
+            if first <= 0.0 and self.start > 0 and last < 1.0:
+                self.slide(-step, first, last)
+                return
+        total = len(self.rows) or 1
+        self.scrollbar.set((self.start + first * count) / total, (self.start + last * count) / total)
+        
+    def slide(self, step, first, last):
+        """滑动窗口并保持当前可见的行不动"""
+        top = self.start + first * len(self.window)
+        self.sliding = True
+        try:
+            self.show_window(self.start + step)
+            self.tree.yview_moveto((top - self.start) / max(len(self.window), 1))
+        finally:
+            self.sliding = False
+            
+    def yview(self, *args):
+        """滚动条命令：拖动时按全部数据定位，其余滚动交给Treeview"""
+        if args and args[0] == "moveto":
+            target = float(args[1]) * len(self.rows)
+            if not self.start <= target < self.start + len(self.window) - self.page_size // 4:
+                self.show_window(int(target) - self.page_size // 4)
+            self.tree.yview_moveto((target - self.start) / max(len(self.window), 1))
+        else:
+            self.tree.yview(*args)
+
+# 书架封面网格：Canvas上只绘制可见范围内的单元格，缩略图在单元格可见时才请求加载
+class CoverGrid:
+    CELL_WIDTH = 120
+    CELL_HEIGHT = 190
+    
+    def __init__(self, canvas, scrollbar, request_thumbnail, thumb_size, max_photos=400):
+        self.canvas = canvas
+        self.scrollbar = scrollbar
+        self.request_thumbnail = request_thumbnail  # 行ID -> Future，完成后调用set_thumbnail
+        self.thumb_size = thumb_size
+        self.max_photos = max_photos
+        self.rows = []  # 全部行 [(行ID, (书名, 版本))]，版本变化时重新加载缩略图
+        self.photos = OrderedDict()  # (行ID, 版本) -> PhotoImage，None表示没有封面
+        self.pending = {}  # (行ID, 版本) -> 加载中的Future
+        self.selected = None
+        self.columns = 1
+        self.redraw_scheduled = False
+        canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.configure(command=self.yview)
+        canvas.bind("<Configure>", self.on_configure)
+        canvas.bind("<Button-1>", self.on_click)
+        canvas.bind("<MouseWheel>", lambda e: self.yview("scroll", -1 if e.delta > 0 else 1, "units"))
+        canvas.bind("<Button-4>", lambda e: self.yview("scroll", -1, "units"))
+        canvas.bind("<Button-5>", lambda e: self.yview("scroll", 1, "units"))
+        
+    def set_rows(self, rows):
+        self.rows = list(rows)
+        if self.selected not in dict(self.rows):
+            self.selected = None
+        self.update_scrollregion()
+        self.draw()
+        
+    def selection(self):
+        return (self.selected,) if self.selected is not None else ()
+        
+    def on_configure(self, event=None):
+        columns = max(1, self.canvas.winfo_width() // self.CELL_WIDTH)
+        if columns != self.columns:
+            self.columns = columns
+            self.update_scrollregion()
+        self.draw()
+        
+    def update_scrollregion(self):
+        rows = (len(self.rows) + self.columns - 1) // self.columns
+        self.canvas.configure(scrollregion=(0, 0, self.columns * self.CELL_WIDTH, rows * self.CELL_HEIGHT),
+                              yscrollincrement=self.CELL_HEIGHT // 4)
+        
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.draw()
+        
+    def on_click(self, event):
+        column = int(event.x // self.CELL_WIDTH)
+        index = int(self.canvas.canvasy(event.y) // self.CELL_HEIGHT) * self.columns + column
+        if column < self.columns and 0 <= index < len(self.rows):
+            self.selected = self.rows[index][0]
+            self.draw()
+            self.canvas.event_generate("<<CoverSelect>>")
+            
+    def draw(self):
+        """重绘可见的单元格，并为缺少缩略图的单元格请求加载"""
+        self.redraw_scheduled = False
+        self.canvas.delete("cell")
+        top = self.canvas.canvasy(0)
+        first = int(top // self.CELL_HEIGHT) * self.columns
+        last = int((top + self.canvas.winfo_height()) // self.CELL_HEIGHT + 1) * self.columns
+        thumb_width, thumb_height = self.thumb_size
+        
+        visible = set()
+        for index in range(first, min(last, len(self.rows))):
+            iid, (title, version) = self.rows[index]
+            key = (iid, version)
+            visible.add(key)
+            x = (index % self.columns) * self.CELL_WIDTH + self.CELL_WIDTH // 2
+            y = (index // self.columns) * self.CELL_HEIGHT + 8
+            if iid == self.selected:
+                self.canvas.create_rectangle(x - self.CELL_WIDTH // 2 + 2, y - 6, x + self.CELL_WIDTH // 2 - 2,
+                                             y + self.CELL_HEIGHT - 6, fill="#d6eaf8", outline="#3498db", tags="cell")
+            photo = self.photos.get(key)
+            if photo is not None:
+                self.photos.move_to_end(key)
+                self.canvas.create_image(x, y + thumb_height - photo.height(), anchor="n", image=photo, tags="cell")
+            else:
+                self.canvas.create_rectangle(x - thumb_width // 2, y, x + thumb_width // 2, y + thumb_height,
+                                             fill="#dfe6e9", outline="#b2bec3", tags="cell")
+                if key not in self.photos and key not in self.pending:
+                    self.pending[key] = self.request_thumbnail(iid, version)
+            self.canvas.create_text(x, y + thumb_height + 6, text=title, anchor="n", width=self.CELL_WIDTH - 12,
+                                    font=("Arial", 9), tags="cell")
+                                    
+        # 取消已滚出视图、尚未开始的加载任务
+        for key in [key for key in self.pending if key not in visible]:
+            self.pending.pop(key).cancel()
+            
+    def set_thumbnail(self, iid, version, image):
+        """在UI线程中保存加载完成的缩略图，多张图片到达时只重绘一次"""
+        key = (iid, version)
+        self.pending.pop(key, None)
+        self.photos[key] = ImageTk.PhotoImage(image) if image is not None else None
+        while len(self.photos) > self.max_photos:
+            self.photos.popitem(last=False)
+        if not self.redraw_scheduled:
+            self.redraw_scheduled = True
+            self.canvas.after_idle(self.draw)
+
+# 后台线程到UI线程的消息分发：后台线程只把消息放入队列，不调用任何Tk方法；
+# UI线程定时检查队列并批量处理，同一键的进度类更新只保留最新一条，在整个程序运行期间有效
+class UIDispatcher:
+    TIME_BUDGET = 0.02  # 每次处理的时间上限（秒），超出后让出事件循环
+    POLL_INTERVAL = 15  # 队列为空时检查的间隔（毫秒）
+    
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.pending = deque()  # (回调, 参数)
+        self.latest = OrderedDict()  # 键 -> (回调, 参数)，只保留最新一条
+        # 在UI线程中创建，之后由drain自己安排下一次检查
+        self.root.after(self.POLL_INTERVAL, self.drain)
+        
+    def post(self, callback, *args):
+        """在UI线程中调用callback(*args)，可在任意线程调用"""
+        with self.lock:
+            self.pending.append((callback, args))
+            
+    def post_latest(self, key, callback, *args):
+        """同post，但相同key未处理的旧消息会被替换"""
+        with self.lock:
+            self.latest[key] = (callback, args)
+            
+    def drain(self):
+        """在UI线程中批量处理消息，回调的异常交给Tk的report_callback_exception"""
+        deadline = time.perf_counter() + self.TIME_BUDGET
+        delay = self.POLL_INTERVAL
+        try:
+            while True:
+                with self.lock:
+                    if self.pending:
+                        callback, args = self.pending.popleft()
+                    elif self.latest:
+                        _, (callback, args) = self.latest.popitem(last=False)
+                    else:
+                        break
+                try:
+                    callback(*args)
+                except Exception:
+                    self.root.report_callback_exception(*sys.exc_info())
+                if time.perf_counter() > deadline:
+                    # 剩余消息留到下一轮，避免界面卡顿
+                    delay = 1
+                    break
+        finally:
+            self.root.after(delay, self.drain)
+
+def atomic_write(path, data):
+    """先写临时文件再替换，避免留下不完整的文件"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def file_content_hash(file_path, chunk_size=1024 * 1024):
+    """计算文件内容哈希，用作缓存键"""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# 章节缓存类：按估算字节数限制容量的LRU缓存（ImageCache也基于此）
+class ChapterCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+            
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            
+            # 超过总容量的条目不缓存
+            if size > self.max_bytes:
+                return
+            
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            
+            # 淘汰最久未使用的条目
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+                
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+            
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            
+    def stats(self):
+        """返回缓存命中统计"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+# 记录当前线程建立连接（含TLS握手）的耗时，复用连接时为0
+_connect_timing = threading.local()
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool
+        }
+
+# 共享的HTTP会话：连接复用、指数退避重试和请求耗时统计
+class HttpClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    
+    def __init__(self, pool_size=4, retries=3, backoff=0.5, backoff_max=8.0):
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "EPubReaderApp/1.0"
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.metrics = deque(maxlen=100)  # 最近请求的耗时记录
+        self.lock = threading.Lock()
+        
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+        
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+        
+    def request(self, method, url, **kwargs):
+        """发送请求，连接错误、超时和可重试的状态码会按指数退避重试"""
+        attempt = 0
+        while True:
+            _connect_timing.seconds = 0.0
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                attempt += 1
+                continue
+                
+            if response.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                delay = self.retry_delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            
+            # 流式响应的总耗时在读取完成后由finish补充
+            timing = {
+                "url": url,
+                "status": response.status_code,
+                "attempts": attempt + 1,
+                "connect": _connect_timing.seconds,
+                "ttfb": response.elapsed.total_seconds(),
+                "total": None if kwargs.get("stream") else time.perf_counter() - start,
+                "start": start
+            }
+            response.timing = timing
+            with self.lock:
+                self.metrics.append(timing)
+            return response
+            
+    def retry_delay(self, attempt, retry_after=None):
+        """计算重试等待时间：指数退避加随机抖动，优先遵循Retry-After"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+        
+    def finish(self, response):
+        """流式响应读取完成后记录总耗时"""
+        timing = getattr(response, "timing", None)
+        if timing is not None and timing["total"] is None:
+            timing["total"] = time.perf_counter() - timing["start"]
+        return timing
+
+def git_blob_sha(file_path, chunk_size=1024 * 1024):
+    """计算文件的Git blob SHA（与GitHub目录API返回的sha一致）"""
+    digest = hashlib.sha1(b"blob %d\0" % os.path.getsize(file_path))
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# 可续传的分段下载：数据先写入.part文件，进度记录在.part.json中，
+# 中断后按HTTP Range继续；大文件拆成多个区间并发下载，校验通过后原子移动到目标路径
+class ResumableDownload:
+    def __init__(self, http, url, dest_path, expected_size=None, expected_sha=None,
+                 max_segments=4, min_segment_size=1024 * 1024, resume_attempts=3, progress=None):
+        self.http = http
+        self.url = url
+        self.dest_path = dest_path
+        self.part_path = dest_path + ".part"
+        self.state_path = dest_path + ".part.json"
+        self.expected_size = expected_size
+        self.expected_sha = expected_sha
+        self.max_segments = max_segments
+        self.min_segment_size = min_segment_size
+        self.resume_attempts = resume_attempts
+        self.progress = progress
+        self.state = None
+        self.checkpoints = {}  # 区间起始位置 -> 已写入磁盘的字节数，只有这部分进度会被保存
+        self.downloaded = 0
+        self.timing = None  # 首个请求的连接/首字节耗时
+        self.lock = threading.Lock()
+        
+    def run(self):
+        self.state = self.load_state()
+        if self.state is None:
+            self.state = self.plan()
+            # 新的下载计划，丢弃旧的临时文件
+            with open(self.part_path, "wb"):
+                pass
+            self.checkpoints = {segment[0]: 0 for segment in self.state["segments"]}
+            self.save_state()
+        else:
+            self.checkpoints = {segment[0]: segment[2] for segment in self.state["segments"]}
+        self.downloaded = sum(segment[2] for segment in self.state["segments"])
+        
+        # 连接中断时从已下载的位置继续
+        attempt = 0
+        while True:
+            pending = [segment for segment in self.state["segments"] if not self.segment_complete(segment)]
+            if not pending:
+                break
+            try:
+                if len(pending) > 1:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                        for future in [pool.submit(self.fetch_segment, segment) for segment in pending]:
+                            future.result()
+                else:
+                    self.fetch_segment(pending[0])
+            except (requests.RequestException, IOError):
+                self.save_state()
+                if attempt >= self.resume_attempts:
+                    raise
+                time.sleep(self.http.retry_delay(attempt))
+                attempt += 1
+        
+        self.verify()
+        os.replace(self.part_path, self.dest_path)
+        os.remove(self.state_path)
+        return self.dest_path
+        
+    def plan(self):
+        """探测文件大小和是否支持Range，规划下载区间"""
+        response = self.http.get(self.url, headers={"Range": "bytes=0-0"}, stream=True, timeout=30)
+        response.raise_for_status()
+        self.timing = response.timing
+        total = None
+        ranges = False
+        if response.status_code == 206:
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                total = int(content_range.rsplit("/", 1)[1])
+                ranges = True
+        elif response.headers.get("Content-Length", "").isdigit():
+            total = int(response.headers["Content-Length"])
+        response.close()
+        if total is None:
+            total = self.expected_size
+        
+        # 每段为 [起始位置, 结束位置(含), 已下载字节数]，大小未知时结束位置为None
+        if total and ranges and total >= self.min_segment_size * 2:
+            count = min(self.max_segments, total // self.min_segment_size)
+            step = total // count
+            bounds = [i * step for i in range(count)] + [total]
+            segments = [[bounds[i], bounds[i + 1] - 1, 0] for i in range(count)]
+        else:
+            segments = [[0, total - 1 if total else None, 0]]
+        return {"url": self.url, "size": total, "ranges": ranges, "segments": segments}
+        
+    def load_state(self):
+        """读取上次中断时保存的进度"""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get("url") != self.url or not os.path.exists(self.part_path):
+            return None
+        if self.expected_size and state.get("size") not in (None, self.expected_size):
+            return None
+        return state
+        
+    def save_state(self):
+        # 各区间的进度使用检查点，而不是内存中尚未写入磁盘的计数
+        with self.lock:
+            state = dict(self.state, segments=[[start, end, self.checkpoints.get(start, 0)]
+                                               for start, end, _ in self.state["segments"]])
+            data = json.dumps(state).encode("utf-8")
+        atomic_write(self.state_path, data)
+        
+    def checkpoint(self, f, segment):
+        """区间的数据写入磁盘后才记录它的进度，中断后续传不会跳过未写入的数据"""
+        f.flush()
+        os.fsync(f.fileno())
+        with self.lock:
+            self.checkpoints[segment[0]] = segment[2]
+        self.save_state()
+        
+    def segment_complete(self, segment):
+        start, end, done = segment
+        return end is not None and done >= end - start + 1
+        
+    def fetch_segment(self, segment):
+        """下载一个区间，已下载的部分通过Range跳过"""
+        start, end, done = segment
+        headers = {}
+        if done > 0 or len(self.state["segments"]) > 1:
+            headers["Range"] = f"bytes={start + done}-{'' if end is None else end}"
+        response = self.http.get(self.url, headers=headers, stream=True, timeout=30)
+        response.raise_for_status()
+        if self.timing is None:
+            self.timing = response.timing
+        
+        if headers and response.status_code != 206:
+            # 服务器不支持断点续传，只能从头下载
+            if len(self.state["segments"]) > 1:
+                raise IOError("服务器不支持分段下载")
+            with self.lock:
+                self.downloaded -= segment[2]
+                segment[2] = 0
+                self.checkpoints[start] = 0
+        
+        with open(self.part_path, "r+b") as f:
+            f.seek(start + segment[2])
+            if end is None:
+                f.truncate()
+            last_save = time.monotonic()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if not chunk:  # 过滤掉保持连接的新块
+                    continue
+                if end is not None:
+                    chunk = chunk[:end - start + 1 - segment[2]]
+                f.write(chunk)
+                with self.lock:
+                    segment[2] += len(chunk)
+                    self.downloaded += len(chunk)
+                    downloaded = self.downloaded
+                if self.progress:
+                    self.progress(downloaded, self.state["size"])
+                # 定期保存本区间的进度
+                if time.monotonic() - last_save > 1.0:
+                    self.checkpoint(f, segment)
+                    last_save = time.monotonic()
+        
+            if end is None:
+                # 大小未知的下载在连接正常结束后即完成
+                with self.lock:
+                    segment[1] = start + segment[2] - 1
+                    self.state["size"] = segment[2]
+            self.checkpoint(f, segment)
+        if not self.segment_complete(segment):
+            raise IOError("连接中断，下载不完整")
+            
+    def verify(self):
+        """校验文件大小和GitHub blob sha，失败时删除临时文件"""
+        size = os.path.getsize(self.part_path)
+        error = None
+        if self.state["size"] is not None and size != self.state["size"]:
+            error = f"文件大小不符: {size} != {self.state['size']}"
+        elif self.expected_size and size != self.expected_size:
+            error = f"文件大小不符: {size} != {self.expected_size}"
+        elif self.expected_sha and git_blob_sha(self.part_path) != self.expected_sha:
+            error = "文件校验失败"
+        if error:
+            os.remove(self.part_path)
+            os.remove(self.state_path)
+            raise IOError(error)
+
+# 书架元数据索引（SQLite）：逐个比较文件的大小和mtime增量更新，
+# 通过路径直接查找书籍，避免每次操作都扫描书架目录
+class BookshelfIndex:
+    def __init__(self, db_path, bookshelf_dir):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.bookshelf_dir = bookshelf_dir
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS books ("
+                "path TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER, mtime REAL, "
+                "hash TEXT, title TEXT, author TEXT, language TEXT, cover_href TEXT)")
+            # 旧版本的索引缺少元数据列
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(books)")}
+            for column in ("language", "cover_href"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE books ADD COLUMN {column} TEXT")
+            # 书架以外打开的文件（加载本地EPUB）的哈希，再次打开时无需重新计算
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)")
+            
+    def sync(self):
+        """增量更新索引，返回 (新增, 删除, 更新) 的路径列表
+        
+        目录mtime不能说明文件是否变化（原地覆盖文件不会更新目录mtime，网络共享的目录mtime也不可靠），
+        所以每次都检查每个文件；只有变化的文件才需要重新计算哈希和元数据
+        """
+        with self.lock:
+            known = {r["path"]: (r["size"], r["mtime"])
+                     for r in self.conn.execute("SELECT path, size, mtime FROM books")}
+        
+        added = []
+        updated = []
+        seen = set()
+        with os.scandir(self.bookshelf_dir) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(".epub") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                path = os.path.join(self.bookshelf_dir, entry.name)
+                seen.add(path)
+                old = known.get(path)
+                if old is None:
+                    added.append((path, entry.name, stat.st_size, stat.st_mtime))
+                elif old != (stat.st_size, stat.st_mtime):
+                    updated.append((stat.st_size, stat.st_mtime, path))
+        removed = [path for path in known if path not in seen]
+        
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO books (path, filename, size, mtime) VALUES (?, ?, ?, ?)", added)
+            # 文件内容变化后，哈希和元数据需要重新获取
+            self.conn.executemany(
+                "UPDATE books SET size = ?, mtime = ?, hash = NULL, title = NULL, author = NULL, "
+                "language = NULL, cover_href = NULL WHERE path = ?", updated)
+            self.conn.executemany("DELETE FROM books WHERE path = ?", [(path,) for path in removed])
+        return [row[0] for row in added], removed, [row[2] for row in updated]
+        
+    def probe_metadata(self):
+        """为尚未读取元数据的书籍探测书名、作者等信息，返回更新的数量"""
+        with self.lock:
+            paths = [row["path"] for row in self.conn.execute("SELECT path FROM books WHERE title IS NULL")]
+        
+        results = []
+        for path in paths:
+            try:
+                metadata = probe_epub_metadata(path) or {}
+            except Exception as e:
+                print(f"读取书籍元数据失败 {os.path.basename(path)}: {e}")
+                metadata = {}
+            # 空字符串表示已探测但没有书名，避免每次刷新都重试
+            results.append((metadata.get("title") or "", metadata.get("author"),
+                            metadata.get("language"), metadata.get("cover_href"), path))
+            
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE books SET title = ?, author = ?, language = ?, cover_href = ? WHERE path = ?", results)
+        return len(results)
+        
+    def rows(self):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute("SELECT * FROM books ORDER BY filename")]
+            
+    def get(self, path):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM books WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+        
+    def set_hash(self, path, book_hash):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE books SET hash = ? WHERE path = ?", (book_hash, path))
+            
+    def content_hash(self, path):
+        """文件内容哈希：文件大小和修改时间与记录一致时直接使用记录的哈希，否则重新计算并记录；
+        书架中的书籍记录在books表中，其他文件记录在file_hashes表中"""
+        stat = os.stat(path)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT size, mtime, hash FROM books WHERE path = ? "
+                "UNION ALL SELECT size, mtime, hash FROM file_hashes WHERE path = ?", (path, path)).fetchall()
+        for row in rows:
+            if row["hash"] and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime):
+                return row["hash"]
+                
+        book_hash = file_content_hash(path)
+        with self.lock, self.conn:
+            if not self.conn.execute("UPDATE books SET hash = ? WHERE path = ?", (book_hash, path)).rowcount:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO file_hashes (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime, book_hash))
+        return book_hash
+            
+    def remove(self, path):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM books WHERE path = ?", (path,))
+
+# 磁盘解析缓存：每本书一个目录，保存章节列表和已渲染章节的片段
+# 使用marshal+zlib存储，格式变化时需要递增版本号
+class ParseCache:
+    VERSION = 5
+    
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        
+    @classmethod
+    def make_key(cls, book_hash, mtime):
+        return f"v{cls.VERSION}-{book_hash}-{int(mtime)}"
+        
+    def _read(self, key, name):
+        path = os.path.join(self.cache_dir, key, name)
+        try:
+            with open(path, "rb") as f:
+                return marshal.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取解析缓存失败: {e}")
+            return None
+            
+    def _write(self, key, name, value):
+        try:
+            atomic_write(os.path.join(self.cache_dir, key, name), zlib.compress(marshal.dumps(value)))
+        except Exception as e:
+            print(f"写入解析缓存失败: {e}")
+            
+    def load_book(self, key):
+        return self._read(key, "book.bin")
+        
+    def save_book(self, key, record):
+        self._write(key, "book.bin", record)
+        
+    def load_chapter(self, key, index):
+        return self._read(key, f"{index}.bin")
+        
+    def save_chapter(self, key, index, content):
+        self._write(key, f"{index}.bin", content)
+
+# 封面缩略图磁盘缓存：按书籍哈希保存缩小后的PNG，重新打开书架时无需再次解码原图
+class ThumbnailCache:
+    SIZE = (96, 136)  # 缩略图最大尺寸（宽, 高）
+    
+    def __init__(self, cache_dir, size=SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+        
+    def path(self, book_hash):
+        return os.path.join(self.cache_dir, f"{book_hash}-{self.size[0]}x{self.size[1]}.png")
+        
+    def load(self, book_hash):
+        try:
+            image = Image.open(self.path(book_hash))
+            image.load()
+            return image
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取缩略图缓存失败: {e}")
+            return None
+            
+    def build(self, file_path, cover_href, book_hash):
+        """从EPUB中读取封面图片并生成缩略图（在工作线程中调用）"""
+        with open_book_archive(file_path) as zip_file:
+            data = zip_file.read(cover_href)
+            
+        image = Image.open(io.BytesIO(data))
+        # JPEG解码时直接按比例缩小，不需要解码完整尺寸的封面
+        image.draft("RGB", self.size)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        image.thumbnail(self.size, Image.LANCZOS)
+        
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        atomic_write(self.path(book_hash), buffer.getvalue())
+        return image
+
+# 全文索引：SQLite FTS5倒排索引（trigram分词，支持中文子串查询）
+# 按段落保存书籍正文及其在章节中的偏移量，随书架增量更新
+class FullTextIndex:
+    VERSION = 1  # 表结构或正文提取方式变化时递增，已索引的书籍会重新建立索引
+    SNIPPET_CHARS = 20  # 搜索结果中命中位置前后显示的字符数
+    
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # 索引线程写入、UI线程查询，WAL模式下两个连接互不阻塞
+        self.writer = sqlite3.connect(db_path, check_same_thread=False)
+        self.reader = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.writer:
+            self.writer.execute("PRAGMA journal_mode=WAL")
+            self.writer.execute(
+                "CREATE TABLE IF NOT EXISTS fulltext_books ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, version INTEGER, title TEXT, "
+                "first_row INTEGER, last_row INTEGER)")
+            self.writer.execute(
+                "CREATE TABLE IF NOT EXISTS fulltext_chapters ("
+                "path TEXT, chapter INTEGER, title TEXT, PRIMARY KEY (path, chapter))")
+            try:
+                self.writer.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5("
+                    "text, path UNINDEXED, chapter UNINDEXED, position UNINDEXED, tokenize='trigram')")
+                self.trigram = True
+            except sqlite3.OperationalError:
+                # 旧版SQLite不支持trigram分词，退化为逐行扫描
+                self.writer.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5("
+                    "text, path UNINDEXED, chapter UNINDEXED, position UNINDEXED)")
+                self.trigram = False
+            # trigram无法匹配1-2个字符的查询（中文的常见情况），另建一个二元组表：
+            # 每段正文写成以空格分隔的相邻字符对，单字查询用前缀匹配，双字查询用完整匹配
+            created = not self.writer.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'fulltext_grams'").fetchone()
+            self.writer.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS fulltext_grams USING fts5(grams, tokenize='unicode61', prefix='1')")
+            if created:
+                # 已有的索引没有二元组，标记为需要重建
+                self.writer.execute("UPDATE fulltext_books SET version = NULL")
+                
+    @staticmethod
+    def short_grams(text):
+        """段落的二元组文本，最后一个字符单独成词，保证每个字符都是某个词的开头"""
+        text = text.lower()
+        return " ".join(text[i:i + 2] for i in range(len(text)))
+        
+    def stale_books(self, rows):
+        """对比书架索引，返回 (需要重建索引的书架行, 已移除的路径)"""
+        with self.lock:
+            indexed = {path: (size, mtime, version) for path, size, mtime, version
+                       in self.writer.execute("SELECT path, size, mtime, version FROM fulltext_books")}
+        current = {row["path"] for row in rows}
+        stale = [row for row in rows
+                 if indexed.get(row["path"]) != (row["size"], row["mtime"], self.VERSION)]
+        removed = [path for path in indexed if path not in current]
+        return stale, removed
+        
+    def replace_book(self, path, size, mtime, title, chapters):
+        """写入一本书的索引，chapters为 (章节标题, 章节正文) 列表"""
+        rows = []
+        for chapter, (_, text) in enumerate(chapters):
+            position = 0
+            for line in text.split("\n"):
+                if line.strip():
+                    rows.append((line, path, chapter, position))
+                position += len(line) + 1
+                
+        with self.lock, self.writer:
+            self._delete(path)
+            first_row = last_row = None
+            if rows:
+                first_row = (self.writer.execute("SELECT max(rowid) FROM fulltext").fetchone()[0] or 0) + 1
+                last_row = first_row + len(rows) - 1
+                self.writer.executemany(
+                    "INSERT INTO fulltext (rowid, text, path, chapter, position) VALUES (?, ?, ?, ?, ?)",
+                    [(first_row + i,) + row for i, row in enumerate(rows)])
+                self.writer.executemany(
+                    "INSERT INTO fulltext_grams (rowid, grams) VALUES (?, ?)",
+                    [(first_row + i, self.short_grams(row[0])) for i, row in enumerate(rows)])
+            self.writer.executemany(
+                "INSERT INTO fulltext_chapters (path, chapter, title) VALUES (?, ?, ?)",
+                [(path, chapter, chapter_title) for chapter, (chapter_title, _) in enumerate(chapters)])
+            self.writer.execute(
+                "INSERT INTO fulltext_books (path, size, mtime, version, title, first_row, last_row) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, self.VERSION, title, first_row, last_row))
+                
+    def remove_book(self, path):
+        with self.lock, self.writer:
+            self._delete(path)
+            
+    def _delete(self, path):
+        # 按rowid区间删除，避免扫描未建索引的path列
+        row = self.writer.execute(
+            "SELECT first_row, last_row FROM fulltext_books WHERE path = ?", (path,)).fetchone()
+        if row and row[0] is not None:
+            self.writer.execute("DELETE FROM fulltext WHERE rowid BETWEEN ? AND ?", row)
+            self.writer.execute("DELETE FROM fulltext_grams WHERE rowid BETWEEN ? AND ?", row)
+        self.writer.execute("DELETE FROM fulltext_chapters WHERE path = ?", (path,))
+        self.writer.execute("DELETE FROM fulltext_books WHERE path = ?", (path,))
+        
+    def search(self, query, limit=200):
+        """查询包含关键词的段落，返回 (书籍, 章节, 偏移量) 命中列表"""
+        query = query.strip()
+        if not query:
+            return []
+        select = "SELECT f.path, f.chapter, f.position, f.text, b.title, c.title "
+        joins = ("JOIN fulltext_books b ON b.path = f.path "
+                 "LEFT JOIN fulltext_chapters c ON c.path = f.path AND c.chapter = f.chapter ")
+        sql = select + "FROM fulltext f " + joins
+        if self.trigram and len(query) >= 3:
+            # 短语查询走倒排索引
+            sql += "WHERE fulltext MATCH ? ORDER BY f.rowid LIMIT ?"
+            params = ('"' + query.replace('"', '""') + '"', limit)
+        elif len(query) <= 2 and any(char.isalnum() for char in query):
+            # 1-2个字符的查询由二元组表按rowid顺序给出候选段落，在候选段落中确认，找到limit条后停止
+            grams = '"' + query.lower().replace('"', '""') + '"' + ("*" if len(query) == 1 else "")
+            sql = (select + "FROM fulltext_grams g JOIN fulltext f ON f.rowid = g.rowid " + joins +
+                   "WHERE fulltext_grams MATCH ? AND instr(lower(f.text), lower(?)) > 0 ORDER BY g.rowid LIMIT ?")
+            params = (grams, query, limit)
+        else:
+            # 只含标点的短查询（或SQLite不支持trigram）只能逐行扫描，找到limit条后停止
+            sql += "WHERE instr(lower(f.text), lower(?)) > 0 ORDER BY f.rowid LIMIT ?"
+            params = (query, limit)
+        
+        hits = []
+        lowered = query.lower()
+        for path, chapter, position, text, book_title, chapter_title in self.reader.execute(sql, params):
+            start = max(text.lower().find(lowered), 0)
+            snippet_start = max(start - self.SNIPPET_CHARS, 0)
+            snippet = text[snippet_start:start + len(query) + self.SNIPPET_CHARS]
+            hits.append({
+                "path": path,
+                "book_title": book_title,
+                "chapter": chapter,
+                "chapter_title": chapter_title or f"章节 {chapter+1}",
+                "offset": position + start,
+                "length": len(query),
+                "snippet": ("..." if snippet_start else "") + snippet
+            })
+        return hits
+
+# 渲染片段中表示图片的标记，对应片段的文本为图片src
+IMAGE_RUN = "__image__"
+# 图片加载完成前显示的单字符占位符
+IMAGE_PLACEHOLDER = "\u25a1"
+# 每张图片（或占位符）之后插入的换行
+IMAGE_SUFFIX = "\n\n"
+
+# 渐进式渲染参数：首屏字符数、单次insert的最大字符数、每批的时间预算（秒）
+RENDER_FIRST_BATCH_CHARS = 4000
+RENDER_BATCH_CHARS = 16000
+RENDER_TIME_BUDGET = 0.012
+
+class RenderRunBuilder:
+    """把章节内容展开为扁平的 (文本, 标签) 片段列表，相邻同标签文本自动合并"""
+    def __init__(self):
+        self.runs = []
+        self.parts = []
+        self.tag = None
+        self.length = 0  # 已生成的纯文本长度（图片计为占位符加换行）
+        self.anchors = {}  # 元素id -> 在纯文本中的偏移量
+        
+    def text(self, text, tag):
+        if self.parts and tag != self.tag:
+            self.flush()
+        self.tag = tag
+        self.parts.append(text)
+        self.length += len(text)
+        
+    def image(self, src):
+        self.flush()
+        self.runs.append((src, IMAGE_RUN))
+        self.length += len(IMAGE_PLACEHOLDER + IMAGE_SUFFIX)
+        
+    def anchor(self, name):
+        self.anchors.setdefault(name, self.length)
+        
+    def flush(self):
+        if self.parts:
+            self.runs.append(("".join(self.parts), self.tag))
+            self.parts = []
+            
+    def finish(self):
+        self.flush()
+        return self.runs
+
+def estimate_runs_size(runs):
+    """估算渲染片段占用的内存字节数"""
+    return sum(len(text) for text, _ in runs) * 2 + len(runs) * 100
+
+def runs_plain_text(runs):
+    """渲染片段对应的纯文本，图片计为占位符加换行（与insert_image插入的内容相同），与文本区域中的偏移量一致"""
+    return "".join(IMAGE_PLACEHOLDER + IMAGE_SUFFIX if tag == IMAGE_RUN else text for text, tag in runs)
+
+class TextFindIndex:
+    """章节纯文本的查找：在小写文本上用str.find定位，逐键输入时只在上一次的结果中筛选"""
+    def __init__(self, text):
+        lowered = text.lower()
+        # 极少数字符小写后长度会变化，此时退化为区分大小写，保证偏移量不变
+        self.ignore_case = len(lowered) == len(text)
+        self.text = lowered if self.ignore_case else text
+        self.results = {}  # 关键词 -> 匹配位置列表
+        
+    def find(self, query):
+        if self.ignore_case:
+            query = query.lower()
+        if not query:
+            return []
+        matches = self.results.get(query)
+        if matches is not None:
+            return matches
+            
+        # 在较短关键词的结果中筛选，否则扫描全文（str.find为C实现，耗时只与匹配数有关）
+        candidates = self.results.get(query[:-1])
+        if candidates is not None:
+            matches = [p for p in candidates if self.text.startswith(query, p)]
+        else:
+            matches = []
+            position = self.text.find(query)
+            while position >= 0:
+                matches.append(position)
+                position = self.text.find(query, position + 1)
+        
+        if len(self.results) >= 64:
+            self.results.clear()
+        self.results[query] = matches
+        return matches
+
+def local_name(tag):
+    """去掉XML命名空间前缀"""
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ""
+
+def find_opf_path(zip_file):
+    """从META-INF/container.xml中读取OPF文件在压缩包内的路径"""
+    root = ET.fromstring(zip_file.read("META-INF/container.xml"))
+    for element in root.iter():
+        if element.tag.endswith("rootfile") and element.get("full-path"):
+            return element.get("full-path")
+    return None
+
+# 内存映射的压缩包：打开时只解析中央目录，成员在读取时才从映射中解压，
+# 最近解压的成员保存在按字节数限制的LRU中；阅读、书架元数据探测和封面缩略图共用，
+# 通过open_book_archive打开，zip64、加密等特殊格式抛出ValueError后退回zipfile
+class MappedZipFile:
+    EOCD_SIGNATURE = b"PK\x05\x06"
+    CENTRAL_SIGNATURE = b"PK\x01\x02"
+    CENTRAL_HEADER = struct.Struct("<4s4xHH8xIIHHH8xI")
+    
+    def __init__(self, file_path, max_cached_bytes=8 * 1024 * 1024):
+        with open(file_path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.max_cached_bytes = max_cached_bytes
+        self.cache = OrderedDict()  # 成员名 -> 解压后的数据
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        try:
+            self.members = self.read_central_directory()  # 成员名 -> (压缩方式, 压缩后大小, 原始大小, 本地文件头偏移)
+        except Exception:
+            self.map.close()
+            raise
+            
+    def read_central_directory(self):
+        tail_start = max(0, len(self.map) - 22 - 0xFFFF)
+        pos = self.map.rfind(self.EOCD_SIGNATURE, tail_start)
+        if pos < 0 or pos + 22 > len(self.map):
+            raise ValueError("未找到压缩包目录")
+        directory_size, directory_offset = struct.unpack_from("<II", self.map, pos + 12)
+        if directory_offset == 0xFFFFFFFF:
+            raise ValueError("不支持zip64格式")
+            
+        members = {}
+        pos = directory_offset
+        end = directory_offset + directory_size
+        while pos + self.CENTRAL_HEADER.size <= end:
+            (signature, flags, method, compressed_size, size,
+             name_length, extra_length, comment_length, offset) = self.CENTRAL_HEADER.unpack_from(self.map, pos)
+            if signature != self.CENTRAL_SIGNATURE:
+                break
+            if flags & 0x1:
+                raise ValueError("不支持加密的压缩包")
+            start = pos + self.CENTRAL_HEADER.size
+            # 与zipfile一致：设置了UTF-8标志时按UTF-8解码，否则按cp437
+            name = self.map[start:start + name_length].decode("utf-8" if flags & 0x800 else "cp437")
+            members[name] = (method, compressed_size, size, offset)
+            pos = start + name_length + extra_length + comment_length
+        return members
+        
+    def namelist(self):
+        return list(self.members)
+        
+    def read(self, name):
+        with self.lock:
+            data = self.cache.get(name)
+            if data is not None:
+                self.cache.move_to_end(name)
+                return data
+                
+        method, compressed_size, size, offset = self.members[name]
+        name_length, extra_length = struct.unpack_from("<HH", self.map, offset + 26)
+        start = offset + 30 + name_length + extra_length
+        data = self.map[start:start + compressed_size]
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15, size or zlib.DEF_BUF_SIZE)
+        elif method != zipfile.ZIP_STORED:
+            raise ValueError(f"不支持的压缩方式: {method}")
+            
+        if len(data) <= self.max_cached_bytes:
+            with self.lock:
+                if name not in self.cache:
+                    self.cache[name] = data
+                    self.cached_bytes += len(data)
+                # 淘汰最近最少使用的成员
+                while self.cached_bytes > self.max_cached_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+        return data
+        
+    def close(self):
+        with self.lock:
+            self.cache.clear()
+            self.cached_bytes = 0
+        self.map.close()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc):
+        self.close()
+
+# 延迟读取的EPUB项目：与ebooklib的项目类混合使用，isinstance判断不变，
+# 内容不常驻内存，每次get_content时从MappedZipFile读取（命中LRU时无需再次解压）
+class LazyEpubContent:
+    classes = {}  # ebooklib项目类 -> 对应的延迟读取类
+    
+    @classmethod
+    def wrap(cls, item, zip_file, member):
+        eager_class = type(item)
+        lazy_class = cls.classes.get(eager_class)
+        if lazy_class is None:
+            lazy_class = type(f"Lazy{eager_class.__name__}", (cls, eager_class), {"eager_class": eager_class})
+            cls.classes[eager_class] = lazy_class
+        item.__class__ = lazy_class
+        item.zip_file = zip_file
+        item.zip_member = member
+        
+    def get_content(self, *args, **kwargs):
+        # 在浅拷贝上填充内容再调用原来的方法，多个线程同时读取同一项目时互不影响
+        item = copy.copy(self)
+        item.__class__ = self.eager_class
+        item.content = self.zip_file.read(self.zip_member)
+        return item.get_content(*args, **kwargs)
+
+# 按需读取的EPUB：代替epub.read_epub，压缩包通过MappedZipFile内存映射，
+# 加载时只读取container.xml、OPF和目录文件，其余成员在使用时才解压
+class MappedEpubReader(epub.EpubReader):
+    def __init__(self, file_path, zip_file, options=None):
+        super().__init__(file_path, options)
+        self.shared_zip = zip_file  # 由调用方打开和关闭（BookSource），图片也从同一个压缩包读取
+        self.loading_manifest = False
+        self.eager_members = set()  # 加载过程中就需要解析的成员（NCX和导航文档）
+        self.manifest_members = []  # 按读取顺序记录的manifest成员
+        
+    def _load(self):
+        # 与epub.EpubReader._load相同，但不在加载后关闭压缩包
+        self.zf = self.shared_zip
+        self._load_container()
+        self._load_opf_file()
+        
+    def read_file(self, name):
+        name = posixpath.normpath(name)
+        if self.loading_manifest:
+            self.manifest_members.append(name)
+            if name not in self.eager_members:
+                if name not in self.zf.members:
+                    raise KeyError(name)
+                return b""
+        return self.zf.read(name)
+        
+    def _load_manifest(self):
+        # 回退到zipfile时与epub.read_epub相同，全部成员都在加载时读取
+        if not isinstance(self.zf, MappedZipFile):
+            return super()._load_manifest()
+            
+        for element in self.container.iter():
+            if local_name(element.tag) == "item" and element.get("href") and (
+                    element.get("media-type") == "application/x-dtbncx+xml"
+                    or "nav" in (element.get("properties") or "").split()):
+                href = urllib.parse.unquote(element.get("href"))
+                self.eager_members.add(posixpath.normpath(posixpath.join(self.opf_dir, href)))
+                # ebooklib读取导航文档时没有解码href，两种写法都预先读取
+                self.eager_members.add(posixpath.normpath(posixpath.join(self.opf_dir, element.get("href"))))
+                
+        first = len(self.book.items)
+        self.loading_manifest = True
+        try:
+            super()._load_manifest()
+        finally:
+            self.loading_manifest = False
+            
+        # 依赖ebooklib为manifest中每个项目按顺序读取一次成员；
+        # 数量对不上时（ebooklib实现变化）无法确定对应关系，丢弃结果后全部在加载时读取
+        items = self.book.items[first:]
+        if len(items) != len(self.manifest_members):
+            print(f"按需读取失败，整本读取 {os.path.basename(self.file_name)}")
+            del self.book.items[first:]
+            return super()._load_manifest()
+        for item, member in zip(items, self.manifest_members):
+            if member not in self.eager_members:
+                LazyEpubContent.wrap(item, self.zf, member)
+
+def open_book_archive(file_path):
+    """内存映射打开EPUB压缩包，zip64等MappedZipFile不支持的格式退回zipfile"""
+    try:
+        return MappedZipFile(file_path)
+    except ValueError as e:
+        print(f"使用zipfile读取 {os.path.basename(file_path)}: {e}")
+        return zipfile.ZipFile(file_path)
+
+# 一本书的EPUB来源：持有这本书唯一打开的压缩包，章节和图片都从中读取；
+# 从解析缓存恢复时，后台线程需要章节内容才解析整本书；
+# 每次加载书籍创建新的实例，切换或删除书籍前关闭，释放文件句柄和内存映射
+class BookSource:
+    def __init__(self, file_path, read_book):
+        self.file_path = file_path
+        self.read_book = read_book
+        self.zip_file = open_book_archive(file_path)
+        self.book = None
+        self.closed = False
+        self.lock = threading.Lock()
+        
+    def load_book(self):
+        """读取整本书，只在第一次需要时解析"""
+        with self.lock:
+            if self.closed:
+                raise ValueError(f"书籍已关闭: {os.path.basename(self.file_path)}")
+            if self.book is None:
+                self.book = self.read_book(self.file_path, self.zip_file)
+            return self.book
+        
+    def get_item(self, chapter):
+        """获取章节对应的EPUB项目"""
+        item = chapter.get("item")
+        if item is None:
+            item = self.load_book().get_item_with_href(chapter["path"])
+            chapter["item"] = item
+        return item
+        
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.book = None
+            self.zip_file.close()
+
+def probe_epub_metadata(file_path):
+    """只读取container.xml和OPF获取书名、作者、语言和封面路径，不加载整本书"""
+    with open_book_archive(file_path) as zip_file:
+        opf_path = find_opf_path(zip_file)
+        if not opf_path:
+            return None
+        root = ET.fromstring(zip_file.read(opf_path))
+        
+    metadata = {"title": None, "author": None, "language": None, "cover_href": None}
+    cover_id = None
+    manifest = {}
+    for element in root.iter():
+        name = local_name(element.tag)
+        if name in ("title", "creator", "language"):
+            key = "author" if name == "creator" else name
+            if metadata[key] is None and element.text and element.text.strip():
+                metadata[key] = element.text.strip()
+        elif name == "meta" and element.get("name") == "cover":
+            cover_id = element.get("content")
+        elif name == "item":
+            manifest[element.get("id")] = element
+            # EPUB3：封面图片在manifest中标记为cover-image
+            if "cover-image" in (element.get("properties") or "").split():
+                metadata["cover_href"] = element.get("href")
+                
+    # EPUB2：通过<meta name="cover">指向manifest中的图片
+    if metadata["cover_href"] is None and cover_id in manifest:
+        metadata["cover_href"] = manifest[cover_id].get("href")
+    if metadata["cover_href"] is None:
+        for item_id, element in manifest.items():
+            if (element.get("media-type") or "").startswith("image/") and "cover" in (item_id or "").lower():
+                metadata["cover_href"] = element.get("href")
+                break
+                
+    # 封面路径相对于OPF文件，转换为压缩包内的路径
+    if metadata["cover_href"]:
+        href = urllib.parse.unquote(metadata["cover_href"].split('#')[0])
+        metadata["cover_href"] = posixpath.normpath(posixpath.join(posixpath.dirname(opf_path), href))
+    return metadata
+
+# 图片资源索引：只记录图片对应的压缩包成员，需要显示时才读取数据
+class ImageResourceIndex:
+    def __init__(self, zip_file):
+        self.zip_file = zip_file  # 书籍的压缩包，由BookSource打开和关闭
+        self.members = {}  # 路径或文件名 -> 压缩包成员名
+        self.sources = []  # 按添加顺序记录的 (路径, 成员名)，用于写入解析缓存
+        
+    def add(self, path, member):
+        self.sources.append((path, member))
+        self.members[path] = member
+        filename = os.path.basename(path)
+        if filename not in self.members:
+            self.members[filename] = member
+            
+    def __contains__(self, path):
+        return path in self.members
+        
+    def read(self, path):
+        member = self.members.get(path)
+        if member is None:
+            return None
+        return self.zip_file.read(member)
+
+# 章节列表解析：按目录（NCX/导航文档）或spine顺序生成章节描述信息
+# 阅读器和全文索引共用同一套逻辑，保证两者的章节序号一致
+class ChapterListParser:
+    def __init__(self, book):
+        self.book = book
+        self.chapters = []
+        self.chapter_titles = []
+        self.used_titles = set()
+        self.title_counters = {}  # 标题 -> 下一个可用的编号
+        self.documents = {}  # 文档路径 -> 第一个指向该文档的章节序号
+        
+        # spine索引：一次建立文档路径 -> (spine位置, 项目)，章节只保存轻量描述信息
+        items_by_id = {item.get_id(): item for item in book.get_items()}
+        self.spine_items = []
+        self.spine_index = {}
+        for pos, (item_id, _) in enumerate(book.spine):
+            item = items_by_id.get(item_id)
+            if item is not None:
+                self.spine_items.append((pos, item))
+                self.spine_index.setdefault(item.file_name, (pos, item))
+        
+    def extract_book_title(self):
+        """从元数据中提取书籍标题 - 优化性能"""
+        try:
+            # 方法1: 从DC元数据获取
+            metadata = self.book.get_metadata('DC', 'title')
+            if metadata:
+                return metadata[0][0]
+            
+            # 方法2: 尝试从封面或第一页获取标题
+            for item in self.book.get_items():
+                if isinstance(item, epub.EpubHtml):
+                    soup = BeautifulSoup(item.get_content(), 'html.parser')
+                    if soup.title and soup.title.string:
+                        return soup.title.string.strip()
+            
+            # 方法3: 使用文件名作为标题
+            return os.path.splitext(os.path.basename(self.book.file_name))[0]
+        except:
+            return "未知标题"
+
+    def parse_table_of_contents(self):
+        """解析目录结构获取章节信息 - 单次遍历目录树"""
+        try:
+            # 获取NCX目录（标准目录格式）
+            ncx_items = [item for item in self.book.get_items() 
+                         if isinstance(item, epub.EpubNcx)]
+            
+            if ncx_items:
+                ncx_root = ET.fromstring(ncx_items[0].get_content())
+                nav_map = next((e for e in ncx_root.iter() if local_name(e.tag) == "navMap"), ncx_root)
+                self.add_toc_entries(self.iter_nav_points(nav_map, 1))
+                return
+            
+            # 尝试HTML目录（较新的EPUB3格式）
+            nav_items = [item for item in self.book.get_items() 
+                         if isinstance(item, epub.EpubNav)]
+            
+            if not nav_items:
+                # 备选方法：查找包含目录的HTML文件
+                nav_items = [item for item in self.book.get_items()
+                            if isinstance(item, epub.EpubHtml) and 
+                            ('toc' in item.file_name.lower() or 'nav' in item.file_name.lower())]
+            
+            if nav_items:
+                nav_content = nav_items[0].get_content()
+                try:
+                    nav_root = ET.fromstring(nav_content)
+                except ET.ParseError:
+                    # 不是合法的XHTML，只能按平铺的链接处理
+                    nav_soup = BeautifulSoup(nav_content, 'html.parser')
+                    self.add_toc_entries((1, link.get_text().strip(), link['href'])
+                                         for link in nav_soup.find_all('a', href=True))
+                    return
+                # 优先使用 epub:type="toc" 的导航元素
+                navs = [e for e in nav_root.iter() if local_name(e.tag) == "nav"]
+                toc_nav = next((e for e in navs if any(
+                    local_name(k) == "type" and "toc" in v.split() for k, v in e.attrib.items())), None)
+                self.add_toc_entries(self.iter_nav_list(toc_nav if toc_nav is not None else nav_root, 1))
+                if not self.chapters:
+                    # 链接不在列表中时按平铺的链接处理
+                    self.add_toc_entries((1, "".join(e.itertext()).strip(), e.get("href"))
+                                         for e in nav_root.iter() if local_name(e.tag) == "a")
+                return
+            
+        except Exception as e:
+            print(f"解析目录时出错: {e}")
+
+    def iter_nav_points(self, element, level):
+        """按文档顺序遍历NCX目录点，生成 (层级, 标题, 链接)"""
+        for child in element:
+            if local_name(child.tag) != "navPoint":
+                continue
+            title = ""
+            src = None
+            for node in child:
+                name = local_name(node.tag)
+                if name == "navLabel":
+                    title = "".join(node.itertext()).strip()
+                elif name == "content":
+                    src = node.get("src")
+            yield level, title, src
+            yield from self.iter_nav_points(child, level + 1)
+
+    def iter_nav_list(self, element, level):
+        """按文档顺序遍历导航文档中的嵌套列表，生成 (层级, 标题, 链接)"""
+        for child in element:
+            name = local_name(child.tag)
+            if name == "li":
+                link = next((e for e in child if local_name(e.tag) == "a"), None)
+                if link is not None and link.get("href"):
+                    yield level, "".join(link.itertext()).strip(), link.get("href")
+                for sub in child:
+                    if local_name(sub.tag) == "ol":
+                        yield from self.iter_nav_list(sub, level + 1)
+            elif name not in ("a", "head"):
+                yield from self.iter_nav_list(child, level)
+
+    def add_toc_entries(self, entries):
+        """把目录项添加为章节，按链接（含片段）去重，并记录层级和上级章节"""
+        seen = set()
+        parents = []  # (层级, 章节序号) 栈
+        for level, title, src in entries:
+            if not src or src in seen:
+                continue
+            seen.add(src)
+            
+            href, _, anchor = src.partition('#')
+            content_path = self.resolve_path(href)
+            entry = self.spine_index.get(content_path)
+            chapter_item = entry[1] if entry else self.book.get_item_with_href(content_path)
+            if not chapter_item or not isinstance(chapter_item, epub.EpubHtml):
+                continue
+                
+            while parents and parents[-1][0] >= level:
+                parents.pop()
+            parent = parents[-1][1] if parents else None
+            self.add_chapter(chapter_item, title, level, parent, anchor or None)
+            parents.append((level, len(self.chapters) - 1))
+
+    def parse_chapters_fallback(self):
+        """备用的章节解析方法 - 优化性能"""
+        try:
+            # 按spine顺序（阅读顺序）处理项目
+            for idx, (_, item) in enumerate(self.spine_items):
+                if isinstance(item, epub.EpubHtml):
+                    # 尝试从文档中提取标题（不构建DOM树）
+                    title = extract_html_title(item.get_content()) or f"章节 {idx+1}"
+                    
+                    self.add_chapter(item, title)
+        
+        except Exception as e:
+            print(f"备用章节解析失败: {e}")
+
+    def add_chapter(self, item, title, level=1, parent=None, anchor=None):
+        """添加章节到列表中 - 优化性能"""
+        title = self.unique_title(title)
+        self.chapter_titles.append(title)
+        
+        # 只存储章节描述信息，内容在首次显示时才解析
+        # 指向同一文档的章节共用一份解析结果（document），通过anchor定位
+        self.chapters.append({
+            "path": item.file_name,
+            "title": title,
+            "spine_index": self.spine_index.get(item.file_name, (None, None))[0],
+            "level": level,
+            "parent": parent,
+            "anchor": anchor,
+            "document": self.documents.setdefault(item.file_name, len(self.chapters)),
+            "item": item
+        })
+
+    def unique_title(self, title):
+        """确保章节标题唯一，每个标题记录下一个编号，避免逐个尝试"""
+        if title not in self.used_titles:
+            self.used_titles.add(title)
+            return title
+        counter = self.title_counters.get(title, 1)
+        candidate = f"{title} ({counter})"
+        while candidate in self.used_titles:
+            counter += 1
+            candidate = f"{title} ({counter})"
+        self.title_counters[title] = counter + 1
+        self.used_titles.add(candidate)
+        return candidate
+
+    @memoize(maxsize=1024, key=lambda self, path: path)
+    def resolve_path(self, path):
+        """解析相对路径为绝对路径 - 优化性能"""
+        # 处理绝对路径
+        if path.startswith('/'):
+            return path[1:]
+        
+        # 处理相对路径 - 这里需要知道基础路径，但EPUBlib不直接提供
+        # 在大多数情况下，路径已经是绝对路径
+        return path
+
+# 图像缓存类：复用ChapterCache的字节预算LRU
+# 解码后的PIL原图与Tk PhotoImage分开缓存，窗口宽度变化时无需重新解码；
+# 键包含书籍哈希，不同书籍中路径相同的图片（如images/cover.jpg）不会混淆
+class ImageCache(ChapterCache):
+    def __init__(self, max_bytes=96 * 1024 * 1024):
+        super().__init__(max_bytes)
+        
+    def get_photo(self, book_hash, path, text_width):
+        # 复合键包含文本宽度以适应不同尺寸
+        return self.get(("photo", book_hash, path, text_width))
         
-    def put(self, key, value, chapter_dir, text_width):
-        composite_key = (key, text_width)
+    def put_photo(self, book_hash, path, photo, text_width):
+        self.put(("photo", book_hash, path, text_width), photo, photo.width() * photo.height() * 4)
         
-        if len(self.cache) >= self.max_size:
-            # 找到最近最少使用的项目
-            lru_key = min(self.access_counter, key=self.access_counter.get)
-            del self.cache[lru_key]
-            del self.access_counter[lru_key]
+    def get_source(self, book_hash, path):
+        return self.get(("source", book_hash, path))
         
-        self.cache[composite_key] = value
-        self.access_counter[composite_key] = self.counter
-        self.counter += 1
+    def put_source(self, book_hash, path, image):
+        self.put(("source", book_hash, path), image, image.width * image.height * len(image.getbands()))
 
 class EPubReaderApp:
     def __init__(self, root):
@@ -189,7 +1871,7 @@ class EPubReaderApp:
             tree_frame, 
             columns=("title", "size", "date"),  # 增加书名列
             show="headings",
-            selectmode="browse"
+            selectmode="extended"  # 支持多选批量下载
         )
         # 设置列标题
         self.search_tree.heading("title", text="书名")
@@ -204,8 +1886,8 @@ class EPubReaderApp:
         self.search_tree.bind("<<TreeviewSelect>>", self.on_search_select)
         
         # 添加滚动条
-        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.search_tree.yview)
-        self.search_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL)
+        self.search_list = VirtualTreeview(self.search_tree, scrollbar)
         
         self.search_tree.grid(row=0, column=0, sticky="nsew")
         scrollbar.grid(row=0, column=1, sticky="ns")
@@ -213,8 +1895,9 @@ class EPubReaderApp:
         # 下载按钮
         button_frame = ttk.Frame(search_frame)
         button_frame.grid(row=3, column=0, sticky="nsew", pady=(5, 0))
-        button_frame.columnconfigure(0, weight=1)
-        button_frame.columnconfigure(1, weight=1)  # 增加第二列的权重分配
+        button_frame.columnconfigure(0, weight=0)
+        button_frame.columnconfigure(1, weight=1)
+        button_frame.columnconfigure(2, weight=1)  # 增加第三列的权重分配
         
         self.download_button = ttk.Button(
             button_frame, 
@@ -224,12 +1907,19 @@ class EPubReaderApp:
         )
         self.download_button.grid(row=0, column=0, sticky="w", padx=(0, 5))
         
+        self.download_all_button = ttk.Button(
+            button_frame, 
+            text="下载全部缺失", 
+            command=self.download_all_missing
+        )
+        self.download_all_button.grid(row=0, column=1, sticky="w", padx=(0, 5))
+        
         open_github_button = ttk.Button(
             button_frame, 
             text="访问GitHub", 
             command=lambda: webbrowser.open("https://github.com/harptwzx/e-book")
         )
-        open_github_button.grid(row=0, column=1, sticky="e")
+        open_github_button.grid(row=0, column=2, sticky="e")
         
         # 书架框架
         bookshelf_frame = ttk.LabelFrame(self.left_paned, text="我的书架")
@@ -244,32 +1934,52 @@ class EPubReaderApp:
         bookshelf_tree_frame.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
         bookshelf_tree_frame.columnconfigure(0, weight=1)
         bookshelf_tree_frame.rowconfigure(0, weight=1)
+        self.bookshelf_tree_frame = bookshelf_tree_frame
         
         # 修改：添加"书名"列
         self.bookshelf_tree = ttk.Treeview(
             bookshelf_tree_frame, 
-            columns=("title", "size", "date"),  # 增加书名列
+            columns=("title", "author", "size", "date"),  # 增加书名列
             show="headings",
             selectmode="browse"
         )
         # 设置列标题
         self.bookshelf_tree.heading("title", text="书名")
+        self.bookshelf_tree.heading("author", text="作者")
         self.bookshelf_tree.heading("size", text="大小")
         self.bookshelf_tree.heading("date", text="日期")
         
         # 设置列宽并允许调整
         self.bookshelf_tree.column("title", width=300, minwidth=250, stretch=tk.YES)
+        self.bookshelf_tree.column("author", width=120, stretch=tk.NO)
         self.bookshelf_tree.column("size", width=80, anchor=tk.CENTER, stretch=tk.NO)
         self.bookshelf_tree.column("date", width=100, anchor=tk.CENTER, stretch=tk.NO)
         
         self.bookshelf_tree.bind("<<TreeviewSelect>>", self.on_bookshelf_select)
         
-        bookshelf_scrollbar = ttk.Scrollbar(bookshelf_tree_frame, orient=tk.VERTICAL, command=self.bookshelf_tree.yview)
-        self.bookshelf_tree.configure(yscrollcommand=bookshelf_scrollbar.set)
+        bookshelf_scrollbar = ttk.Scrollbar(bookshelf_tree_frame, orient=tk.VERTICAL)
+        self.bookshelf_list = VirtualTreeview(self.bookshelf_tree, bookshelf_scrollbar)
         
         self.bookshelf_tree.grid(row=0, column=0, sticky="nsew")
         bookshelf_scrollbar.grid(row=0, column=1, sticky="ns")
         
+        # 书架封面视图（与列表视图占用同一位置，切换时显示其中之一）
+        self.cover_frame = ttk.Frame(bookshelf_frame)
+        self.cover_frame.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
+        self.cover_frame.columnconfigure(0, weight=1)
+        self.cover_frame.rowconfigure(0, weight=1)
+        
+        cover_canvas = tk.Canvas(self.cover_frame, background="#f5f5f5", highlightthickness=0)
+        cover_scrollbar = ttk.Scrollbar(self.cover_frame, orient=tk.VERTICAL)
+        self.cover_grid = CoverGrid(cover_canvas, cover_scrollbar, self.request_thumbnail, ThumbnailCache.SIZE)
+        cover_canvas.bind("<<CoverSelect>>", self.on_bookshelf_select)
+        cover_canvas.bind("<Double-Button-1>", lambda e: self.load_from_bookshelf())
+        
+        cover_canvas.grid(row=0, column=0, sticky="nsew")
+        cover_scrollbar.grid(row=0, column=1, sticky="ns")
+        self.cover_frame.grid_remove()
+        self.bookshelf_view = self.bookshelf_list  # 当前显示的书架视图
+        
         # 书架按钮
         bookshelf_btn_frame = ttk.Frame(bookshelf_frame)
         bookshelf_btn_frame.grid(row=1, column=0, sticky="nsew", pady=(5, 0))
@@ -311,6 +2021,57 @@ class EPubReaderApp:
         )
         load_local_button.pack(side=tk.RIGHT)
         
+        self.view_button = ttk.Button(
+            right_btn_frame, 
+            text="封面视图", 
+            command=self.toggle_bookshelf_view,
+            width=10
+        )
+        self.view_button.pack(side=tk.RIGHT, padx=(0, 5))
+        
+        # 全文搜索框架
+        fulltext_frame = ttk.LabelFrame(self.left_paned, text="全文搜索")
+        self.left_paned.add(fulltext_frame, weight=2)
+        fulltext_frame.columnconfigure(0, weight=1)
+        fulltext_frame.rowconfigure(1, weight=1)
+        
+        fulltext_container = ttk.Frame(fulltext_frame)
+        fulltext_container.grid(row=0, column=0, sticky="ew", padx=5, pady=5)
+        fulltext_container.columnconfigure(0, weight=1)
+        
+        self.fulltext_entry = ttk.Entry(fulltext_container)
+        self.fulltext_entry.grid(row=0, column=0, sticky="ew", padx=(0, 5))
+        self.fulltext_entry.bind("<Return>", self.search_fulltext)
+        
+        fulltext_button = ttk.Button(fulltext_container, text="搜索", command=self.search_fulltext)
+        fulltext_button.grid(row=0, column=1, sticky="e")
+        
+        fulltext_tree_frame = ttk.Frame(fulltext_frame)
+        fulltext_tree_frame.grid(row=1, column=0, sticky="nsew", padx=5, pady=5)
+        fulltext_tree_frame.columnconfigure(0, weight=1)
+        fulltext_tree_frame.rowconfigure(0, weight=1)
+        
+        self.fulltext_tree = ttk.Treeview(
+            fulltext_tree_frame, 
+            columns=("book", "chapter", "context"),
+            show="headings",
+            selectmode="browse"
+        )
+        self.fulltext_tree.heading("book", text="书名")
+        self.fulltext_tree.heading("chapter", text="章节")
+        self.fulltext_tree.heading("context", text="内容")
+        self.fulltext_tree.column("book", width=100, stretch=tk.NO)
+        self.fulltext_tree.column("chapter", width=100, stretch=tk.NO)
+        self.fulltext_tree.column("context", width=200, minwidth=150, stretch=tk.YES)
+        
+        self.fulltext_tree.bind("<<TreeviewSelect>>", self.on_fulltext_select)
+        
+        fulltext_scrollbar = ttk.Scrollbar(fulltext_tree_frame, orient=tk.VERTICAL, command=self.fulltext_tree.yview)
+        self.fulltext_tree.configure(yscrollcommand=fulltext_scrollbar.set)
+        
+        self.fulltext_tree.grid(row=0, column=0, sticky="nsew")
+        fulltext_scrollbar.grid(row=0, column=1, sticky="ns")
+        
         # 右侧面板
         right_frame = ttk.Frame(self.paned_window)
         self.paned_window.add(right_frame, weight=4)
@@ -342,12 +2103,12 @@ class EPubReaderApp:
         self.next_button.pack(side=tk.LEFT)
         
         # 文本区域框架
-        text_frame = ttk.Frame(right_frame)
-        text_frame.pack(fill=tk.BOTH, expand=True)
+        self.text_frame = ttk.Frame(right_frame)
+        self.text_frame.pack(fill=tk.BOTH, expand=True)
         
         # 滚动文本框
         self.text_area = scrolledtext.ScrolledText(
-            text_frame, 
+            self.text_frame, 
             wrap=tk.WORD, 
             font=("Arial", 12),
             padx=15,
@@ -364,33 +2125,91 @@ class EPubReaderApp:
         self.text_area.tag_configure("normal", font=("Arial", 12), lmargin1=20, lmargin2=20, rmargin=20)
         self.text_area.tag_configure("quote", font=("Arial", 11, "italic"), foreground="#7f8c8d", 
                                     lmargin1=30, lmargin2=30, rmargin=30, spacing1=5, spacing3=5)
+        self.text_area.tag_configure("image_placeholder", font=("Arial", 24), foreground="#bdc3c7")
+        self.text_area.tag_configure("search_hit", background="#f9e79f")
+        self.text_area.tag_configure("find_hit", background="#fcf3cf")
+        self.text_area.tag_configure("find_current", background="#f5b041")
+        
+        # 章节内查找栏（Ctrl+F显示）
+        self.find_frame = ttk.Frame(right_frame)
+        self.find_entry = ttk.Entry(self.find_frame, width=30)
+        self.find_entry.pack(side=tk.LEFT, padx=(0, 5))
+        self.find_entry.bind("<KeyRelease>", self.update_find)
+        self.find_entry.bind("<Return>", self.find_next)
+        self.find_entry.bind("<Shift-Return>", self.find_previous)
+        self.find_entry.bind("<Escape>", self.hide_find_bar)
+        ttk.Button(self.find_frame, text="上一个", command=self.find_previous, width=8).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(self.find_frame, text="下一个", command=self.find_next, width=8).pack(side=tk.LEFT, padx=(0, 5))
+        self.find_label = ttk.Label(self.find_frame, text="")
+        self.find_label.pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(self.find_frame, text="关闭", command=self.hide_find_bar, width=6).pack(side=tk.RIGHT)
+        self.root.bind("<Control-f>", self.show_find_bar)
         
         # 初始化变量
         self.book = None
+        self.book_path = None
+        self.book_source = None  # 当前书籍的EPUB来源，后台任务通过参数获得
         self.chapters = []
         self.chapter_titles = []
         self.current_chapter_index = 0
         self.book_title = ""
+        self.book_hash = ""
         self.image_references = []
-        self.image_resources = {}
+        self.image_resources = None
         self.ncx_toc = None
         self.bookshelf_dir = "bookshelf"
+        self.cache_dir = "cache"
+        self.catalog_cache_path = os.path.join(self.cache_dir, "catalog.json")
         self.github_url = "https://api.github.com/repos/harptwzx/e-book/contents/books"
         self.remote_books = []
-        self.queue = queue.Queue()
+        self.book_filter = None  # 远程书籍过滤索引，书籍列表变化后重建
+        self.book_rows = {}  # 书名 -> 搜索结果中显示的值
+        self.filter_query = None  # 上一次过滤使用的关键词
+        self.filter_timer = None  # 搜索框输入防抖计时器
+        self.dispatcher = UIDispatcher(self.root)  # 后台线程通过它更新界面
         
         # 性能优化相关变量
-        self.image_cache = ImageCache(max_size=50)  # 图片缓存
+        self.image_cache = ImageCache(max_bytes=96 * 1024 * 1024)  # 图片缓存（按像素字节数限制）
         self.last_text_width = 0  # 用于检测文本区域宽度变化
         self.resize_timer = None  # 窗口调整大小计时器
-        self.chapter_cache = {}  # 章节内容缓存
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)  # 线程池
+        self.chapter_cache = ChapterCache(max_bytes=64 * 1024 * 1024)  # 章节内容缓存（按内存占用限制）
+        self.parse_cache = ParseCache(os.path.join(self.cache_dir, "parse"))  # 磁盘解析缓存
+        self.parse_cache_key = None
+        self.max_workers = 4
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)  # 线程池
+        self.download_queue = deque()  # 等待下载的书籍
+        self.max_concurrent_downloads = 2  # 同时进行的下载数
+        self.max_download_segments = 4  # 每个下载的并发分段数
+        # 共享HTTP会话：连接池容纳线程池的请求和所有下载的分段请求，连接不会因池满被丢弃
+        self.http = HttpClient(pool_size=self.max_workers + self.max_concurrent_downloads * self.max_download_segments)
+        self.active_downloads = 0
+        self.download_batch = None  # 当前批次的汇总进度
+        self.download_lock = threading.Lock()
         self.active_threads = set()  # 跟踪活动线程
         self.loading_chapter = None  # 当前正在加载的章节
+        self.render_generation = 0  # 每次切换章节递增，用于丢弃过期的后台结果
+        self.chapter_futures = {}  # 章节序号 -> 处理中的后台任务（含预取）
+        self.prefetch_depth = 1  # 预取当前章节前后各几章
+        self.prefetch_stats = {"hits": 0, "misses": 0}
+        self.image_counter = 0  # 图片占位符编号
+        self.pending_jump = None  # 章节渲染完成后需要跳转的位置 (章节序号, 偏移量, 长度)
+        self.fulltext_hits = {}  # 全文搜索结果行ID -> 命中信息
+        self.current_content = None  # 当前章节的缓存内容（含纯文本）
+        self.offset_shifts = []  # 图片错误提示替换占位符造成的偏移 (正文偏移量, 增加的字符数)
+        self.find_visible = False
+        self.find_index = None  # 当前章节的查找索引，首次查找时建立
+        self.find_query = ""
+        self.find_matches = []
+        self.find_current = -1
         
         # 创建书架目录
         if not os.path.exists(self.bookshelf_dir):
             os.makedirs(self.bookshelf_dir)
+        self.bookshelf_index = BookshelfIndex(os.path.join(self.cache_dir, "bookshelf.db"), self.bookshelf_dir)
+        self.fulltext_index = FullTextIndex(os.path.join(self.cache_dir, "fulltext.db"))
+        self.index_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # 全文索引专用线程，不占用章节预取的线程池
+        self.thumbnail_cache = ThumbnailCache(os.path.join(self.cache_dir, "thumbs"))  # 封面缩略图磁盘缓存
+        self.thumbnail_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)  # 封面解码和缩放
         
         # 显示欢迎信息
         self.show_welcome_message()
@@ -453,6 +2272,7 @@ class EPubReaderApp:
         
         # 搜索区域按钮
         self.download_button.config(width=max(15, min_button_width))
+        self.download_all_button.config(width=max(15, min_button_width))
         
         # 书架区域按钮
         self.load_button.config(width=max(12, min_button_width))
@@ -470,14 +2290,11 @@ class EPubReaderApp:
         if not self.chapters or self.current_chapter_index >= len(self.chapters):
             return
             
-        # 获取当前章节索引
+        # 清空后完整重新渲染当前章节，图片按新宽度缩放
         index = self.current_chapter_index
-        self.text_area.config(state=tk.NORMAL)
-        self.text_area.delete(1.0, tk.END)
-        
-        # 重新显示当前章节
+        self.clear_text_area()
+        self.loading_chapter = None
         self.show_chapter(index)
-        self.text_area.config(state=tk.DISABLED)
 
     def toggle_fullscreen(self, event=None):
         """切换全屏模式 - 优化性能"""
@@ -490,138 +2307,190 @@ class EPubReaderApp:
         self.ensure_buttons_visible()
 
     def start_book_loading(self):
-        """启动书籍加载过程 - 使用线程池优化性能"""
+        """启动书籍加载过程 - 先显示本地缓存的列表，再在后台检查更新"""
         self.status_label.config(text="正在加载远程书籍列表...")
         self.progress_var.set(0)
         self.progress_bar.start()
         
         # 清空现有搜索结果
-        for item in self.search_tree.get_children():
-            self.search_tree.delete(item)
+        self.clear_search_tree()
+        
+        # 立即显示缓存的书籍列表（离线时也可用）
+        catalog = self.read_catalog_cache()
+        if catalog:
+            for book in self.build_book_entries(catalog["items"]):
+                self.add_remote_book(book)
+            self.apply_filter()
+            self.status_label.config(text=f"已显示缓存的 {len(self.remote_books)} 本电子书，正在检查更新...")
             
         # 在线程池中加载书籍
-        future = self.executor.submit(self.load_book_list)
+        future = self.executor.submit(self.load_book_list, catalog)
         future.add_done_callback(self.on_book_loading_complete)
-        
-        # 启动队列处理器
-        self.root.after(100, self.process_queue)
 
     def on_book_loading_complete(self, future):
         """书籍加载完成后的回调"""
         try:
             future.result()
         except Exception as e:
-            self.queue.put(("error", str(e)))
+            self.post_catalog_message("error", str(e))
+
+    def post_catalog_message(self, *msg):
+        """后台线程发送书籍列表消息"""
+        self.dispatcher.post(self.process_catalog_message, msg)
+
+    def process_catalog_message(self, msg):
+        """在UI线程中处理来自后台线程的书籍列表消息"""
+        if msg[0] == "reset":
+            # 远程列表有更新，替换缓存的列表
+            self.clear_search_tree()
+        elif msg[0] == "book":
+            self.add_remote_book(msg[1])
+            # 本批收到的书籍一次性更新到列表
+            self.dispatcher.post_latest("catalog_list", self.apply_filter)
+        elif msg[0] == "done":
+            self.progress_bar.stop()
+            self.progress_var.set(100)
+            self.status_label.config(text=f"找到 {msg[1]} 本电子书")
+            self.apply_filter()
+            self.refresh_bookshelf()
+        elif msg[0] == "offline":
+            self.progress_bar.stop()
+            self.status_label.config(text=f"离线模式: 显示缓存的 {len(self.remote_books)} 本电子书 ({msg[1]})")
+            self.refresh_bookshelf()
+        elif msg[0] == "error":
+            self.progress_bar.stop()
+            self.status_label.config(text=f"错误: {msg[1]}")
+            messagebox.showerror("加载错误", f"无法获取书籍列表: {msg[1]}")
 
-    def process_queue(self):
-        """处理来自后台线程的消息队列"""
+    def read_catalog_cache(self):
+        """读取本地缓存的远程书籍列表"""
         try:
-            while True:
-                msg = self.queue.get_nowait()
-                if msg[0] == "progress":
-                    self.progress_var.set(msg[1])
-                elif msg[0] == "book":
-                    book = msg[1]
-                    # 存储书籍信息
-                    self.remote_books.append(book)
-                    # 在树状视图中显示书籍
-                    # 修改：使用书名列
-                    self.search_tree.insert("", tk.END, values=(book["name"], book["size"], book["date"]))
-                elif msg[0] == "done":
-                    self.progress_bar.stop()
-                    self.status_label.config(text=f"找到 {msg[1]} 本电子书")
-                    self.refresh_bookshelf()
-                    break
-                elif msg[0] == "error":
-                    self.progress_bar.stop()
-                    self.status_label.config(text=f"错误: {msg[1]}")
-                    messagebox.showerror("加载错误", f"无法获取书籍列表: {msg[1]}")
-                    break
-        except queue.Empty:
-            self.root.after(100, self.process_queue)
+            with open(self.catalog_cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取书籍列表缓存失败: {e}")
+            return None
 
-    def load_book_list(self):
-        """从GitHub加载书籍列表 - 优化请求性能"""
+    def write_catalog_cache(self, items, etag, last_modified):
+        """保存远程书籍列表及其ETag/Last-Modified"""
+        catalog = {"etag": etag, "last_modified": last_modified, "items": items}
         try:
-            # 获取GitHub仓库内容
-            headers = {"User-Agent": "EPubReaderApp/1.0"}
-            response = requests.get(self.github_url, headers=headers, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
+            atomic_write(self.catalog_cache_path, json.dumps(catalog, ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            print(f"写入书籍列表缓存失败: {e}")
+
+    def build_book_entries(self, items):
+        """把GitHub目录列表转换为书籍信息"""
+        books = []
+        for item in items:
             # 过滤EPUB文件
-            epub_files = [item for item in data if item["name"].lower().endswith(".epub")]
-            total = len(epub_files)
-            
-            if total == 0:
-                self.queue.put(("error", "未找到EPUB文件"))
-                return
+            if not item["name"].lower().endswith(".epub"):
+                continue
                 
-            # 处理每个文件
-            for idx, item in enumerate(epub_files):
-                # 转换文件大小
-                size = item["size"]
-                if size < 1024:
-                    size_str = f"{size} B"
-                elif size < 1024 * 1024:
-                    size_str = f"{size/1024:.1f} KB"
+            # 转换文件大小
+            size = item["size"]
+            size_str = format_size(size)
+            
+            # 尝试获取日期，如果不可用则使用当前日期
+            try:
+                # 尝试不同的日期字段
+                if "updated_at" in item:
+                    date_str = item["updated_at"].split("T")[0]
+                elif "git_last_modified" in item:
+                    date_str = item["git_last_modified"].split("T")[0]
                 else:
-                    size_str = f"{size/(1024*1024):.1f} MB"
-                
-                # 尝试获取日期，如果不可用则使用当前日期
-                try:
-                    # 尝试不同的日期字段
-                    if "updated_at" in item:
-                        date_str = item["updated_at"].split("T")[0]
-                    elif "git_last_modified" in item:
-                        date_str = item["git_last_modified"].split("T")[0]
-                    else:
-                        date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-                except:
                     date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-                
-                # 添加到队列
-                self.queue.put(("book", {
-                    "name": item["name"],
-                    "size": size_str,
-                    "date": date_str,
-                    "download_url": item["download_url"]
-                }))
-                
-                # 更新进度
-                progress = (idx + 1) / total * 100
-                self.queue.put(("progress", progress))
-                time.sleep(0.01)  # 减少延迟以加快处理速度
-            
-            # 完成加载
-            self.queue.put(("done", total))
+            except:
+                date_str = datetime.datetime.now().strftime("%Y-%m-%d")
             
-        except Exception as e:
-            self.queue.put(("error", str(e)))
+            books.append({
+                "name": item["name"],
+                "size": size_str,
+                "date": date_str,
+                "download_url": item["download_url"],
+                "bytes": size,
+                "sha": item.get("sha")
+            })
+        return books
 
-    def filter_books(self, event=None):
-        """根据搜索框内容过滤书籍 - 优化性能"""
-        query = self.search_entry.get().strip().lower()
+    def load_book_list(self, catalog=None):
+        """从GitHub加载书籍列表 - 使用ETag/Last-Modified条件请求"""
+        headers = {}
+        if catalog:
+            if catalog.get("etag"):
+                headers["If-None-Match"] = catalog["etag"]
+            if catalog.get("last_modified"):
+                headers["If-Modified-Since"] = catalog["last_modified"]
         
-        # 如果没有查询，显示所有书籍
-        if not query:
-            for child in self.search_tree.get_children():
-                self.search_tree.reattach(child, "", "end")
+        try:
+            # 获取GitHub仓库内容
+            response = self.http.get(self.github_url, headers=headers, timeout=10)
+            if response.status_code == 304 and catalog:
+                # 列表未变化，继续使用缓存
+                self.post_catalog_message("done", len(self.remote_books))
+                return
+            response.raise_for_status()
+            data = response.json()
+        except requests.RequestException as e:
+            if catalog:
+                self.post_catalog_message("offline", str(e))
+                return
+            raise
+        
+        self.write_catalog_cache(data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        
+        books = self.build_book_entries(data)
+        total = len(books)
+        if total == 0:
+            self.post_catalog_message("error", "未找到EPUB文件")
             return
             
-        # 隐藏不匹配的书籍
-        for child in self.search_tree.get_children():
-            item_values = self.search_tree.item(child, "values")
-            if item_values and len(item_values) > 0:
-                item_text = item_values[0].lower()  # 书名是第一列
-                if query in item_text:
-                    self.search_tree.reattach(child, "", "end")
-                else:
-                    self.search_tree.detach(child)
+        # 替换缓存的列表
+        self.post_catalog_message("reset")
+        for idx, book in enumerate(books):
+            # 发送到UI线程
+            self.post_catalog_message("book", book)
+            
+            # 更新进度（只保留最新的进度）
+            self.dispatcher.post_latest("catalog_progress", self.progress_var.set, (idx + 1) / total * 100)
+        
+        # 完成加载
+        self.post_catalog_message("done", total)
+
+    def clear_search_tree(self):
+        """清空远程书籍列表，下次过滤时从列表中移除"""
+        self.remote_books = []
+        self.book_filter = None
+
+    def add_remote_book(self, book):
+        """存储书籍信息，下次过滤时显示"""
+        self.remote_books.append(book)
+        self.book_filter = None
+
+    def filter_books(self, event=None):
+        """搜索框输入时延迟过滤，连续输入只执行最后一次"""
+        if self.filter_timer:
+            self.root.after_cancel(self.filter_timer)
+        self.filter_timer = self.root.after(150, self.apply_filter)
+
+    def apply_filter(self):
+        """根据搜索框内容过滤书籍 - 使用过滤索引，列表只更新变化的行"""
+        self.filter_timer = None
+        if self.book_filter is None:
+            self.book_filter = BookFilterIndex(book["name"] for book in self.remote_books)
+            self.book_rows = {book["name"]: (book["name"], book["size"], book["date"]) for book in self.remote_books}
+        query = self.search_entry.get()
+        matches = self.book_filter.match(query)
+        
+        # 关键词变化时回到列表顶部，书籍列表更新时保持位置
+        self.search_list.set_rows([(name, self.book_rows[name]) for name in matches],
+                                  reset_position=query != self.filter_query)
+        self.filter_query = query
 
     def refresh_book_list(self):
         """刷新书籍列表 - 优化性能"""
-        self.remote_books = []
         self.start_book_loading()
 
     def show_welcome_message(self):
@@ -653,128 +2522,372 @@ class EPubReaderApp:
         self.text_area.config(state=tk.DISABLED)
 
     def on_search_select(self, event):
-        selected = self.search_tree.selection()
+        selected = self.search_list.selection()
         if selected:
             self.download_button.config(state=tk.NORMAL)
         else:
             self.download_button.config(state=tk.DISABLED)
 
     def download_selected(self):
-        selected = self.search_tree.selection()
+        """下载选中的一本或多本书籍"""
+        selected = self.search_list.selection()
         if not selected:
             return
-            
-        item = self.search_tree.item(selected[0])
-        # 修改：从values中获取书名
-        values = item["values"]
-        if values and len(values) > 0:
-            book_name = values[0]
-        else:
-            return
         
-        # 检查是否已存在
-        local_path = os.path.join(self.bookshelf_dir, book_name)
+        books_by_name = {book["name"]: book for book in self.remote_books}
+        books = []
+        # 行ID即书名
+        for book_name in selected:
+            book = books_by_name.get(book_name)
+            if book is None:
+                # 如果API没有提供下载URL，尝试直接构建
+                book = {
+                    "name": book_name,
+                    "download_url": f"https://github.com/harptwzx/e-book/raw/main/books/{urllib.parse.quote(book_name)}"
+                }
+            books.append(book)
+        
+        self.download_books(self.confirm_overwrite(books))
+
+    def download_all_missing(self):
+        """下载书架中还没有的全部书籍"""
+        books = [book for book in self.remote_books
+                 if not os.path.exists(os.path.join(self.bookshelf_dir, book["name"]))
+                 or self.local_book_differs(book)]
+        if not books:
+            self.status_label.config(text="书架已包含全部电子书")
+            return
+        self.download_books(self.confirm_overwrite(books))
+
+    def confirm_overwrite(self, books):
+        """已存在但大小不同的书籍需要确认覆盖（大小相同的会在下载时跳过），返回要下载的书籍"""
+        conflicts = [book for book in books if self.local_book_differs(book)]
+        if conflicts:
+            names = "\n".join(book["name"] for book in conflicts[:10])
+            if not messagebox.askyesno("确认", f"以下 {len(conflicts)} 本书已存在，是否覆盖？\n{names}"):
+                books = [book for book in books if book not in conflicts]
+        return books
+
+    def local_book_differs(self, book):
+        """书架中已有同名文件但大小与远程不同"""
+        local_path = os.path.join(self.bookshelf_dir, book["name"])
+        return (os.path.exists(local_path) and book.get("bytes") is not None
+                and os.path.getsize(local_path) != book["bytes"])
+
+    def download_books(self, books):
+        """把书籍加入下载队列 - 限制并发数并汇总进度"""
+        if not books:
+            return
+        batch = self.download_batch
+        if batch is None:
+            batch = self.download_batch = {
+                "start": time.time(),
+                "total_bytes": 0,
+                "progress": {},  # 书名 -> 已下载字节数
+                "done": 0,
+                "skipped": 0,
+                "failed": [],
+                "count": 0,
+                "last_update": 0.0
+            }
+        for book in books:
+            if book["name"] in batch["progress"]:
+                continue
+            batch["progress"][book["name"]] = 0
+            batch["total_bytes"] += book.get("bytes") or 0
+            batch["count"] += 1
+            self.download_queue.append(book)
+        
+        self.progress_bar.stop()
+        self.show_download_progress()
+        self.start_queued_downloads()
+
+    def start_queued_downloads(self):
+        """在并发限制内从队列中启动下载任务"""
+        while self.download_queue and self.active_downloads < self.max_concurrent_downloads:
+            book = self.download_queue.popleft()
+            self.active_downloads += 1
+            # 大小不同（或未知）的同名文件下载完成后会被替换，正在阅读时先关闭
+            if book.get("bytes") is None or self.local_book_differs(book):
+                self.unload_book(os.path.join(self.bookshelf_dir, book["name"]))
+            future = self.executor.submit(self.run_download_job, book)
+            future.add_done_callback(lambda f, book=book: self.dispatcher.post(self.on_download_complete, f, book))
+
+    def run_download_job(self, book):
+        """在后台线程中下载一本书，书架中已有相同文件时跳过"""
+        local_path = os.path.join(self.bookshelf_dir, book["name"])
         if os.path.exists(local_path):
-            if not messagebox.askyesno("确认", f"'{book_name}' 已存在，是否覆盖？"):
+            if book.get("sha"):
+                if git_blob_sha(local_path) == book["sha"]:
+                    return "skipped"
+            elif book.get("bytes") is not None and os.path.getsize(local_path) == book["bytes"]:
+                return "skipped"
+        
+        download_url = book["download_url"]
+        return self.download_book(
+            book["name"], download_url, book.get("bytes"), book.get("sha"),
+            progress=lambda downloaded, total: self.update_download_progress(book["name"], downloaded))
+
+    def update_download_progress(self, book_name, downloaded):
+        """记录单本书的下载进度（后台线程），限制界面刷新频率"""
+        batch = self.download_batch
+        with self.download_lock:
+            batch["progress"][book_name] = downloaded
+            current_time = time.time()
+            if current_time - batch["last_update"] <= 0.5:
                 return
-        
-        # 获取下载URL - 从远程书籍列表中查找
-        download_url = None
-        for book in self.remote_books:
-            if book["name"] == book_name:
-                download_url = book["download_url"]
-                break
-        
-        if not download_url:
-            # 如果API没有提供下载URL，尝试直接构建
-            download_url = f"https://github.com/harptwzx/e-book/raw/main/books/{urllib.parse.quote(book_name)}"
-        
-        self.status_label.config(text=f"正在下载 {book_name}...")
-        # 使用线程池下载
-        future = self.executor.submit(self.download_book, book_name, download_url)
-        future.add_done_callback(lambda f: self.on_download_complete(f, book_name))
+            batch["last_update"] = current_time
+        self.dispatcher.post_latest("download_progress", self.show_download_progress)
 
-    def on_download_complete(self, future, book_name):
-        """下载完成后的回调"""
+    def show_download_progress(self):
+        """在进度条和状态栏显示汇总的下载进度、速度和剩余时间"""
+        batch = self.download_batch
+        if batch is None:
+            return
+        with self.download_lock:
+            downloaded = sum(batch["progress"].values())
+        finished = batch["done"] + batch["skipped"] + len(batch["failed"])
+        elapsed_time = time.time() - batch["start"]
+        download_speed = downloaded / (1024 * elapsed_time) if elapsed_time > 0 else 0
+        
+        if batch["total_bytes"]:
+            self.progress_var.set(min(100, downloaded / batch["total_bytes"] * 100))
+            remaining_time = (batch["total_bytes"] - downloaded) / (download_speed * 1024) if download_speed > 0 else 0
+            eta = f" 剩余: {remaining_time:.1f}s"
+        else:
+            self.progress_var.set(finished / batch["count"] * 100 if batch["count"] else 0)
+            eta = ""
+        self.status_label.config(
+            text=f"下载 {finished}/{batch['count']} 本 "
+                 f"{downloaded/(1024*1024):.1f}MB/{batch['total_bytes']/(1024*1024):.1f}MB "
+                 f"速度: {download_speed:.1f}KB/s{eta}")
+
+    def on_download_complete(self, future, book):
+        """单本下载结束后的回调（UI线程），全部结束时汇总提示一次"""
+        batch = self.download_batch
+        self.active_downloads -= 1
         try:
-            future.result()
-            self.root.after(0, lambda: self.status_label.config(text=f"下载完成: {book_name}"))
-            self.root.after(0, self.refresh_bookshelf)
-            self.root.after(0, lambda: messagebox.showinfo("下载成功", f"'{book_name}' 已添加到书架"))
+            result = future.result()
+            if result == "skipped":
+                batch["skipped"] += 1
+                with self.download_lock:
+                    batch["total_bytes"] -= book.get("bytes") or 0
+                    batch["progress"][book["name"]] = 0
+            else:
+                batch["done"] += 1
+                batch["timing"] = result
+                if book.get("bytes"):
+                    with self.download_lock:
+                        batch["progress"][book["name"]] = book["bytes"]
+                self.refresh_bookshelf()
         except Exception as e:
-            self.root.after(0, lambda: self.status_label.config(text=f"下载失败: {str(e)}"))
-            self.root.after(0, lambda: messagebox.showerror("下载错误", f"无法下载电子书: {str(e)}"))
+            batch["failed"].append((book["name"], str(e)))
+        
+        self.show_download_progress()
+        self.start_queued_downloads()
+        
+        if self.active_downloads == 0 and not self.download_queue:
+            self.download_batch = None
+            self.progress_var.set(100)
+            summary = f"下载完成: 成功 {batch['done']} 本, 跳过 {batch['skipped']} 本, 失败 {len(batch['failed'])} 本"
+            if batch["count"] == 1 and batch["done"] == 1:
+                timing = batch["timing"]
+                summary += (f" (连接 {timing['connect']*1000:.0f}ms, "
+                            f"首字节 {timing['ttfb']*1000:.0f}ms, 总计 {timing['total']:.1f}s)")
+            self.status_label.config(text=summary)
+            if batch["failed"]:
+                details = "\n".join(f"{name}: {error}" for name, error in batch["failed"][:10])
+                messagebox.showerror("下载错误", f"{summary}\n\n{details}")
+            elif batch["done"]:
+                messagebox.showinfo("下载成功", summary)
+
+    def download_book(self, book_name, download_url, expected_size=None, expected_sha=None, progress=None):
+        """下载书籍 - 断点续传的分段下载，校验通过后才移入书架"""
+        start_time = time.time()
+        
+        download = ResumableDownload(
+            self.http, download_url, os.path.join(self.bookshelf_dir, book_name),
+            expected_size=expected_size, expected_sha=expected_sha,
+            max_segments=self.max_download_segments, progress=progress)
+        download.run()
+        
+        # 返回本次下载的耗时统计
+        timing = dict(download.timing or {"connect": 0.0, "ttfb": 0.0})
+        timing["total"] = time.time() - start_time
+        return timing
+
+    def refresh_bookshelf(self):
+        """刷新书架 - 先显示索引中的记录，扫描目录和读取元数据在后台进行"""
+        self.show_bookshelf_rows(self.bookshelf_index.rows())
+        self.index_executor.submit(self.sync_bookshelf)
 
-    def download_book(self, book_name, download_url):
-        """下载书籍 - 优化下载性能"""
+    def sync_bookshelf(self):
+        """后台线程：检查书架目录中每个文件的变化，有变化时更新列表，然后更新全文索引"""
         try:
-            # 下载文件
-            headers = {"User-Agent": "EPubReaderApp/1.0"}
-            response = requests.get(download_url, stream=True, headers=headers, timeout=30)
-            response.raise_for_status()
-            
-            # 保存文件
-            local_path = os.path.join(self.bookshelf_dir, book_name)
-            with open(local_path, "wb") as f:
-                total_size = int(response.headers.get('content-length', 0))
-                downloaded = 0
-                start_time = time.time()
-                last_update = time.time()
-                
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:  # 过滤掉保持连接的新块
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # 限制更新频率 - 每0.5秒更新一次
-                        current_time = time.time()
-                        if current_time - last_update > 0.5:
-                            last_update = current_time
-                            
-                            # 计算下载速度和剩余时间
-                            elapsed_time = current_time - start_time
-                            download_speed = downloaded / (1024 * elapsed_time) if elapsed_time > 0 else 0
-                            remaining_time = (total_size - downloaded) / (download_speed * 1024) if download_speed > 0 else 0
-                            
-                            # 更新状态
-                            self.root.after(0, lambda: self.status_label.config(
-                                text=f"下载 {book_name}: {downloaded/1024:.1f}KB/{total_size/1024:.1f}KB "
-                                     f"({downloaded/total_size*100:.1f}%) "
-                                     f"速度: {download_speed:.1f}KB/s "
-                                     f"剩余: {remaining_time:.1f}s"
-                            ))
+            added, removed, updated = self.bookshelf_index.sync()
+            # 新增或变化的书籍只读取OPF元数据，结果保存在索引中
+            probed = self.bookshelf_index.probe_metadata()
+            if added or removed or updated or probed:
+                self.dispatcher.post_latest("bookshelf", self.show_bookshelf_rows, self.bookshelf_index.rows())
+        except Exception as e:
+            print(f"同步书架失败: {e}")
+        self.update_fulltext_index()
+
+    def show_bookshelf_rows(self, index_rows):
+        """显示书架索引中的记录"""
+        # 书架中的电子书以文件路径作为行ID，列表只更新变化的行
+        rows = []
+        covers = []
+        for row in index_rows:
+            date = time.strftime("%Y-%m-%d", time.localtime(row["mtime"]))
             
+            # 优先显示元数据中的书名，没有时使用文件名（去除扩展名）
+            book_name = row["title"] or os.path.splitext(row["filename"])[0]
+            # 修改：使用书名列
+            rows.append((row["path"], (book_name, row["author"] or "", format_size(row["size"]), date)))
+            # 文件修改时间作为封面版本，文件替换后重新加载缩略图
+            covers.append((row["path"], (book_name, row["mtime"])))
+        self.bookshelf_list.set_rows(rows)
+        self.cover_grid.set_rows(covers)
+
+    def toggle_bookshelf_view(self):
+        """在列表视图和封面视图之间切换"""
+        if self.bookshelf_view is self.bookshelf_list:
+            selected = self.bookshelf_list.selection()
+            self.cover_grid.selected = selected[0] if selected else None
+            self.bookshelf_tree_frame.grid_remove()
+            self.cover_frame.grid()
+            self.bookshelf_view = self.cover_grid
+            self.view_button.config(text="列表视图")
+            self.cover_grid.draw()
+        else:
+            self.cover_frame.grid_remove()
+            self.bookshelf_tree_frame.grid()
+            self.bookshelf_view = self.bookshelf_list
+            self.view_button.config(text="封面视图")
+        self.on_bookshelf_select(None)
+
+    def request_thumbnail(self, file_path, version):
+        """封面视图中的单元格可见时调用，在线程池中加载缩略图"""
+        future = self.thumbnail_executor.submit(self.load_thumbnail, file_path)
+        future.add_done_callback(lambda f: self.dispatcher.post(self.on_thumbnail_ready, file_path, version, f))
+        return future
+
+    def load_thumbnail(self, file_path):
+        """工作线程：优先读取缩略图缓存，没有时从EPUB中的封面生成"""
+        row = self.bookshelf_index.get(file_path)
+        if not row or not row["cover_href"]:
+            return None
+        book_hash = self.bookshelf_index.content_hash(file_path)
+        image = self.thumbnail_cache.load(book_hash)
+        if image is None:
+            image = self.thumbnail_cache.build(file_path, row["cover_href"], book_hash)
+        return image
+
+    def on_thumbnail_ready(self, file_path, version, future):
+        """在UI线程中显示加载完成的缩略图"""
+        if future.cancelled():
+            return
+        try:
+            image = future.result()
         except Exception as e:
-            raise e
+            print(f"加载封面缩略图失败 {os.path.basename(file_path)}: {e}")
+            image = None
+        self.cover_grid.set_thumbnail(file_path, version, image)
 
-    def refresh_bookshelf(self):
-        """刷新书架 - 优化性能"""
-        # 清空书架
-        for item in self.bookshelf_tree.get_children():
-            self.bookshelf_tree.delete(item)
-            
-        # 添加书架中的电子书
-        for filename in os.listdir(self.bookshelf_dir):
-            if filename.lower().endswith(".epub"):
-                filepath = os.path.join(self.bookshelf_dir, filename)
-                size = os.path.getsize(filepath)
-                date = time.strftime("%Y-%m-%d", time.localtime(os.path.getmtime(filepath)))
+    def update_fulltext_index(self):
+        """后台线程：为书架中新增或变化的书籍建立全文索引，并删除已移除书籍的索引"""
+        try:
+            stale, removed = self.fulltext_index.stale_books(self.bookshelf_index.rows())
+            for path in removed:
+                self.fulltext_index.remove_book(path)
                 
-                # 转换文件大小
-                if size < 1024:
-                    size_str = f"{size} B"
-                elif size < 1024 * 1024:
-                    size_str = f"{size/1024:.1f} KB"
-                else:
-                    size_str = f"{size/(1024*1024):.1f} MB"
+            for count, row in enumerate(stale, 1):
+                self.dispatcher.post_latest("status", functools.partial(
+                    self.status_label.config, text=f"正在建立全文索引 ({count}/{len(stale)}): {row['filename']}"))
+                try:
+                    title, chapters = self.extract_book_text(row["path"])
+                except Exception as e:
+                    # 记录为空索引，避免每次刷新都重试无法解析的文件
+                    print(f"建立全文索引失败 {row['filename']}: {e}")
+                    title, chapters = os.path.splitext(row["filename"])[0], []
+                self.fulltext_index.replace_book(row["path"], row["size"], row["mtime"], title, chapters)
                 
-                # 提取书名（去除扩展名）
-                book_name = os.path.splitext(filename)[0]
-                # 修改：使用书名列
-                self.bookshelf_tree.insert("", tk.END, values=(book_name, size_str, date))
+            if stale:
+                self.dispatcher.post_latest("status", functools.partial(
+                    self.status_label.config, text=f"全文索引已更新: {len(stale)} 本书"))
+        except Exception as e:
+            print(f"更新全文索引失败: {e}")
+
+    def extract_book_text(self, file_path):
+        """按阅读器相同的章节划分提取整本书的纯文本，返回 (书名, [(章节标题, 正文)])"""
+        book_hash = self.bookshelf_index.content_hash(file_path)
+        source = BookSource(file_path, self.read_book)
+        try:
+            parser = ChapterListParser(source.load_book())
+            title = self.indexed_book_title(file_path) or parser.extract_book_title()
+            parser.parse_table_of_contents()
+            if not parser.chapters:
+                parser.parse_chapters_fallback()
+            # 共用同一文档的章节只索引一次，命中位置记在文档的第一个章节上
+            return title, [(chapter["title"],
+                            self.build_chapter_content(source, chapter, book_hash)["text"]
+                            if chapter["document"] == index else "")
+                           for index, chapter in enumerate(parser.chapters)]
+        finally:
+            source.close()
+
+    def search_fulltext(self, event=None):
+        """在全文索引中查询关键词"""
+        query = self.fulltext_entry.get()
+        start = time.perf_counter()
+        hits = self.fulltext_index.search(query)
+        elapsed = (time.perf_counter() - start) * 1000
+        
+        for item in self.fulltext_tree.get_children():
+            self.fulltext_tree.delete(item)
+        self.fulltext_hits = {}
+        for hit in hits:
+            item_id = self.fulltext_tree.insert("", tk.END, values=(
+                hit["book_title"], hit["chapter_title"], hit["snippet"].replace("\n", " ")))
+            self.fulltext_hits[item_id] = hit
+        self.status_label.config(text=f"全文搜索: 找到 {len(hits)} 处结果 ({elapsed:.1f} ms)")
+
+    def on_fulltext_select(self, event):
+        """打开搜索结果所在的书籍并跳转到命中位置"""
+        selected = self.fulltext_tree.selection()
+        if not selected or selected[0] not in self.fulltext_hits:
+            return
+        hit = self.fulltext_hits[selected[0]]
+        if not os.path.exists(hit["path"]):
+            messagebox.showerror("错误", f"找不到文件: {os.path.basename(hit['path'])}")
+            return
+            
+        self.pending_jump = (hit["chapter"], hit["offset"], hit["length"])
+        if hit["path"] != self.book_path:
+            self.load_epub(hit["path"], start_index=hit["chapter"])
+        elif 0 <= hit["chapter"] < len(self.chapters):
+            self.loading_chapter = None
+            self.show_chapter(hit["chapter"])
+
+    def apply_pending_jump(self):
+        """章节渲染完成后滚动到待跳转位置并高亮"""
+        chapter, offset, length = self.pending_jump
+        self.pending_jump = None
+        if chapter != self.current_chapter_index:
+            return
+        start = self.body_index(offset)
+        if not length:
+            # 章节锚点：滚动到顶部显示
+            self.text_area.yview(start)
+            return
+        end = self.body_index(offset + length)
+        self.text_area.tag_remove("search_hit", "1.0", tk.END)
+        self.text_area.tag_add("search_hit", start, end)
+        self.text_area.see(start)
 
     def on_bookshelf_select(self, event):
-        selected = self.bookshelf_tree.selection()
+        selected = self.bookshelf_view.selection()
         if selected:
             self.load_button.config(state=tk.NORMAL)
             self.remove_button.config(state=tk.NORMAL)
@@ -783,66 +2896,72 @@ class EPubReaderApp:
             self.remove_button.config(state=tk.DISABLED)
 
     def load_from_bookshelf(self):
-        """从书架加载书籍 - 优化性能"""
-        selected = self.bookshelf_tree.selection()
+        """从书架加载书籍 - 通过行ID直接查找索引"""
+        selected = self.bookshelf_view.selection()
         if not selected:
             return
             
-        item = self.bookshelf_tree.item(selected[0])
-        # 修改：从values中获取书名
-        values = item["values"]
-        if values and len(values) > 0:
-            book_name = values[0]
-        else:
-            return
-        
-        # 在书架目录中查找匹配的文件
-        file_path = None
-        for filename in os.listdir(self.bookshelf_dir):
-            if filename.lower().endswith(".epub") and os.path.splitext(filename)[0] == book_name:
-                file_path = os.path.join(self.bookshelf_dir, filename)
-                break
-        
-        if file_path:
+        file_path = selected[0]
+        row = self.bookshelf_index.get(file_path)
+        if row and os.path.exists(file_path):
             self.load_epub(file_path)
         else:
-            messagebox.showerror("错误", f"找不到文件: {book_name}.epub")
+            messagebox.showerror("错误", f"找不到文件: {os.path.basename(file_path)}")
+            self.refresh_bookshelf()
 
     def remove_from_bookshelf(self):
-        """从书架移除书籍 - 优化性能"""
-        selected = self.bookshelf_tree.selection()
+        """从书架移除书籍 - 通过行ID直接查找索引"""
+        selected = self.bookshelf_view.selection()
         if not selected:
             return
             
-        item = self.bookshelf_tree.item(selected[0])
-        # 修改：从values中获取书名
-        values = item["values"]
-        if values and len(values) > 0:
-            book_name = values[0]
-        else:
+        file_path = selected[0]
+        row = self.bookshelf_index.get(file_path)
+        if not row:
+            messagebox.showerror("错误", f"找不到文件: {os.path.basename(file_path)}")
             return
+        book_name = os.path.splitext(row["filename"])[0]
         
         if not messagebox.askyesno("确认删除", f"确定要从书架中移除 '{book_name}' 吗？"):
             return
             
-        # 在书架目录中查找匹配的文件
-        file_path = None
-        for filename in os.listdir(self.bookshelf_dir):
-            if filename.lower().endswith(".epub") and os.path.splitext(filename)[0] == book_name:
-                file_path = os.path.join(self.bookshelf_dir, filename)
-                break
-        
-        if file_path:
-            try:
-                os.remove(file_path)
-                self.refresh_bookshelf()
-                self.status_label.config(text=f"已移除: {book_name}")
-            except Exception as e:
-                messagebox.showerror("删除错误", f"无法删除文件: {str(e)}")
-        else:
-            messagebox.showerror("错误", f"找不到文件: {book_name}.epub")
+        try:
+            self.unload_book(file_path)
+            os.remove(file_path)
+            self.bookshelf_index.remove(file_path)
+            self.refresh_bookshelf()
+            self.status_label.config(text=f"已移除: {book_name}")
+        except Exception as e:
+            messagebox.showerror("删除错误", f"无法删除文件: {str(e)}")
+
+    def close_book(self):
+        """关闭当前书籍的压缩包并取消预取任务，后台任务持有的旧来源不会再读取"""
+        for future in self.chapter_futures.values():
+            future.cancel()
+        self.chapter_futures = {}
+        if self.book_source is not None:
+            self.book_source.close()
+            self.book_source = None
+        self.book = None
+        self.image_resources = None
+
+    def unload_book(self, file_path):
+        """要删除或覆盖的文件正在阅读时先关闭，否则Windows上无法删除或替换被映射的文件"""
+        if file_path != self.book_path:
+            return
+        self.close_book()
+        self.book_path = None
+        self.chapters = []
+        self.chapter_titles = []
+        self.loading_chapter = None
+        self.pending_jump = None
+        self.chapter_combo.config(values=[])
+        self.chapter_combo.set("")
+        self.prev_button.config(state=tk.DISABLED)
+        self.next_button.config(state=tk.DISABLED)
+        self.clear_text_area()
 
-    def load_epub(self, file_path=None):
+    def load_epub(self, file_path=None, start_index=0):
         """加载EPUB文件 - 使用缓存优化性能"""
         if not file_path:
             file_path = filedialog.askopenfilename(
@@ -852,39 +2971,37 @@ class EPubReaderApp:
                 return
         
         try:
-            # 读取EPUB文件
-            self.book = epub.read_epub(file_path)
             self.chapters = []
             self.chapter_titles = []
             self.image_references = []
-            self.image_resources = {}
             self.ncx_toc = None
-            self.chapter_cache = {}  # 清除之前的章节缓存
-            
-            # 获取书籍标题
-            self.book_title = self.extract_book_title()
-            self.status_label.config(text=f"正在加载: {self.book_title}")
-            self.root.update()
-            
-            # 收集图片资源
-            self.collect_image_resources()
+            self.close_book()
+            self.book_source = BookSource(file_path, self.read_book)
+            self.image_resources = ImageResourceIndex(self.book_source.zip_file)
+            self.book_path = file_path
+            self.current_content = None
+            self.loading_chapter = None
             
-            # 解析目录结构
-            self.parse_table_of_contents()
+            # 以文件内容哈希作为章节缓存键，同名书籍不会冲突；书架中的书籍通常已由后台索引记录
+            self.book_hash = self.bookshelf_index.content_hash(file_path)
+            self.parse_cache_key = ParseCache.make_key(self.book_hash, os.path.getmtime(file_path))
             
-            # 如果没有通过目录找到章节，尝试备用方法
-            if not self.chapters:
-                self.status_label.config(text=f"使用备用方法加载: {self.book_title}")
-                self.root.update()
-                self.parse_chapters_fallback()
+            # 优先使用磁盘上的解析缓存，命中时无需读取和解析整本书
+            record = self.parse_cache.load_book(self.parse_cache_key)
+            if record:
+                self.restore_parse_record(record)
+            else:
+                self.parse_book(file_path)
             
             # 更新UI
             if self.chapters:
-                self.chapter_combo.config(values=self.chapter_titles)
-                self.chapter_combo.current(0)
+                # 按目录层级缩进显示
+                self.chapter_combo.config(values=["    " * (c["level"] - 1) + c["title"] for c in self.chapters])
+                start_index = start_index if 0 <= start_index < len(self.chapters) else 0
+                self.chapter_combo.current(start_index)
                 self.prev_button.config(state=tk.NORMAL)
                 self.next_button.config(state=tk.NORMAL)
-                self.current_chapter_index = 0
+                self.current_chapter_index = start_index
                 self.show_chapter(self.current_chapter_index)
                 self.status_label.config(text=f"已加载: {self.book_title} - 共 {len(self.chapters)} 章")
             else:
@@ -899,177 +3016,96 @@ class EPubReaderApp:
         # 强制垃圾回收释放内存
         gc.collect()
 
-    def extract_book_title(self):
-        """从元数据中提取书籍标题 - 优化性能"""
-        try:
-            # 方法1: 从DC元数据获取
-            metadata = self.book.get_metadata('DC', 'title')
-            if metadata:
-                return metadata[0][0]
-            
-            # 方法2: 尝试从封面或第一页获取标题
-            for item in self.book.get_items():
-                if isinstance(item, epub.EpubHtml):
-                    soup = BeautifulSoup(item.get_content(), 'html.parser')
-                    if soup.title and soup.title.string:
-                        return soup.title.string.strip()
-            
-            # 方法3: 使用文件名作为标题
-            return os.path.splitext(os.path.basename(self.book.file_name))[0]
-        except:
-            return "未知标题"
-
-    def collect_image_resources(self):
-        """收集所有图片资源 - 优化性能"""
-        for item in self.book.get_items():
-            # 修复ITEM_IMAGE问题 - 检查项目是否是图片类型
-            if isinstance(item, epub.EpubImage):
-                path = item.file_name
-                self.image_resources[path] = item.get_content()
-                filename = os.path.basename(path)
-                if filename not in self.image_resources:
-                    self.image_resources[filename] = item.get_content()
-            # 备用方法：检查媒体类型是否为图片
-            elif hasattr(item, 'media_type') and item.media_type and item.media_type.startswith('image/'):
-                path = item.file_name
-                self.image_resources[path] = item.get_content()
-                filename = os.path.basename(path)
-                if filename not in self.image_resources:
-                    self.image_resources[filename] = item.get_content()
-
-    def parse_table_of_contents(self):
-        """解析目录结构获取章节信息 - 优化性能"""
-        try:
-            # 获取NCX目录（标准目录格式）
-            ncx_items = [item for item in self.book.get_items() 
-                         if isinstance(item, epub.EpubNcx)]
-            
-            if ncx_items:
-                ncx_content = ncx_items[0].get_content()
-                ncx_soup = BeautifulSoup(ncx_content, 'xml')
-                nav_points = ncx_soup.find_all('navPoint')
-                self.process_nav_points(nav_points)
-                return
-            
-            # 尝试HTML目录（较新的EPUB3格式）
-            nav_items = [item for item in self.book.get_items() 
-                         if isinstance(item, epub.EpubNav)]
-            
-            if not nav_items:
-                # 备选方法：查找包含目录的HTML文件
-                nav_items = [item for item in self.book.get_items()
-                            if isinstance(item, epub.EpubHtml) and 
-                            ('toc' in item.file_name.lower() or 'nav' in item.file_name.lower())]
-            
-            if nav_items:
-                nav_content = nav_items[0].get_content()
-                nav_soup = BeautifulSoup(nav_content, 'html.parser')
-                nav_links = nav_soup.find_all('a', href=True)
-                self.process_nav_links(nav_links)
-                return
-            
-        except Exception as e:
-            print(f"解析目录时出错: {e}")
-
-    def process_nav_points(self, nav_points):
-        """处理NCX目录点 - 优化性能"""
-        for nav_point in nav_points:
-            # 提取章节标题
-            title = nav_point.find('text').get_text().strip()
-            
-            # 提取内容路径
-            content_src = nav_point.find('content')['src']
-            content_path = self.resolve_path(content_src.split('#')[0])
-            
-            # 获取章节内容
-            chapter_item = self.book.get_item_with_href(content_path)
-            if chapter_item and isinstance(chapter_item, epub.EpubHtml):
-                self.add_chapter(chapter_item, title)
-            
-            # 递归处理子目录
-            child_points = nav_point.find_all('navPoint', recursive=False)
-            if child_points:
-                self.process_nav_points(child_points)
-
-    def process_nav_links(self, nav_links):
-        """处理HTML导航链接 - 优化性能"""
-        for link in nav_links:
-            title = link.get_text().strip()
-            content_src = link['href']
-            content_path = self.resolve_path(content_src.split('#')[0])
-            
-            chapter_item = self.book.get_item_with_href(content_path)
-            if chapter_item and isinstance(chapter_item, epub.EpubHtml):
-                self.add_chapter(chapter_item, title)
-
-    def parse_chapters_fallback(self):
-        """备用的章节解析方法 - 优化性能"""
-        try:
-            # 获取spine顺序（阅读顺序）
-            spine_items = [self.book.get_item_with_id(item[0]) 
-                          for item in self.book.spine 
-                          if self.book.get_item_with_id(item[0])]
-            
-            # 按阅读顺序处理项目
-            for idx, item in enumerate(spine_items):
-                if isinstance(item, epub.EpubHtml):
-                    soup = BeautifulSoup(item.get_content(), 'html.parser')
-                    title = f"章节 {idx+1}"
-                    
-                    # 尝试从文档中提取标题
-                    if soup.title and soup.title.string:
-                        title = soup.title.string.strip()
-                    elif soup.find('h1'):
-                        title = soup.find('h1').get_text().strip()
-                    elif soup.find('h2'):
-                        title = soup.find('h2').get_text().strip()
-                    
-                    self.add_chapter(item, title)
+    def parse_book(self, file_path):
+        """读取并解析EPUB文件，结果写入磁盘缓存"""
+        # 读取EPUB文件
+        self.book = self.book_source.load_book()
         
-        except Exception as e:
-            print(f"备用章节解析失败: {e}")
-
-    def add_chapter(self, item, title):
-        """添加章节到列表中 - 优化性能"""
-        # 确保章节标题唯一
-        base_title = title
-        counter = 1
-        while title in self.chapter_titles:
-            title = f"{base_title} ({counter})"
-            counter += 1
+        parser = ChapterListParser(self.book)
         
-        self.chapter_titles.append(title)
+        # 获取书籍标题（书架中的书籍已在索引中记录元数据）
+        self.book_title = self.indexed_book_title(file_path) or parser.extract_book_title()
+        self.status_label.config(text=f"正在加载: {self.book_title}")
+        self.root.update()
         
-        # 解析章节内容
-        content = item.get_content()
-        soup = BeautifulSoup(content, 'html.parser')
+        # 收集图片资源
+        self.collect_image_resources()
         
-        # 存储章节信息
-        self.chapters.append({
-            "soup": soup,
-            "path": item.file_name,
-            "title": title,
-            "item": item
-        })
+        # 解析目录结构
+        parser.parse_table_of_contents()
+        
+        # 如果没有通过目录找到章节，尝试备用方法
+        if not parser.chapters:
+            self.status_label.config(text=f"使用备用方法加载: {self.book_title}")
+            self.root.update()
+            parser.parse_chapters_fallback()
+        self.chapters = parser.chapters
+        self.chapter_titles = parser.chapter_titles
+        
+        if self.chapters:
+            record = {
+                "book_title": self.book_title,
+                "titles": list(self.chapter_titles),
+                "chapters": [{key: value for key, value in c.items() if key != "item"}
+                             for c in self.chapters],
+                "images": list(self.image_resources.sources)
+            }
+            self.executor.submit(self.parse_cache.save_book, self.parse_cache_key, record)
 
-    def resolve_path(self, path):
-        """解析相对路径为绝对路径 - 优化性能"""
-        # 处理绝对路径
-        if path.startswith('/'):
-            return path[1:]
+    def restore_parse_record(self, record):
+        """从磁盘缓存恢复章节列表和图片索引"""
+        self.book_title = record["book_title"]
+        self.chapter_titles = list(record["titles"])
+        self.chapters = [dict(chapter) for chapter in record["chapters"]]
+        for path, member in record["images"]:
+            self.image_resources.add(path, member)
+
+    def indexed_book_title(self, file_path):
+        """从书架索引中读取已探测的书名"""
+        row = self.bookshelf_index.get(file_path)
+        return row["title"] if row else None
+
+    def read_book(self, file_path, zip_file):
+        """读取EPUB文件：内存映射压缩包，章节内容在使用时才解压；
+        无法映射时整本读取，并释放图片数据（图片按需从压缩包读取）"""
+        reader = MappedEpubReader(file_path, zip_file)
+        book = reader.load()
+        reader.process()
+        for item in book.get_items():
+            if isinstance(item, epub.EpubImage) or (
+                    hasattr(item, 'media_type') and item.media_type and item.media_type.startswith('image/')):
+                item.content = b""
+        return book
+
+    def collect_image_resources(self):
+        """建立图片资源索引 - 只记录位置，不读取图片数据"""
+        zip_file = self.image_resources.zip_file
+        opf_path = find_opf_path(zip_file)
+        opf_dir = posixpath.dirname(opf_path) if opf_path else ""
+        members = set(zip_file.namelist())
         
-        # 处理相对路径 - 这里需要知道基础路径，但EPUBlib不直接提供
-        # 在大多数情况下，路径已经是绝对路径
-        return path
+        for item in self.book.get_items():
+            # 修复ITEM_IMAGE问题 - 检查项目是否是图片类型，备用方法：检查媒体类型是否为图片
+            if isinstance(item, epub.EpubImage) or (
+                    hasattr(item, 'media_type') and item.media_type and item.media_type.startswith('image/')):
+                path = item.file_name
+                member = posixpath.normpath(posixpath.join(opf_dir, path))
+                if member in members:
+                    self.image_resources.add(path, member)
 
     def clear_text_area(self):
         """清除文本区域 - 优化内存管理"""
+        # 使进行中的分批渲染和图片加载失效
+        self.render_generation += 1
         self.text_area.config(state=tk.NORMAL)
         self.text_area.delete(1.0, tk.END)
         self.text_area.config(state=tk.DISABLED)
+        # 文本区域已不再包含任何文档，同文档的锚点跳转必须重新渲染
+        self.current_content = None
         
         # 清除图片引用以释放内存
         self.image_references = []
+        self.offset_shifts = []
         gc.collect()
 
     def show_chapter(self, index):
@@ -1081,55 +3117,157 @@ class EPubReaderApp:
         if self.loading_chapter == index:
             return
             
+        # 跳转到其他章节时放弃未完成的定位
+        if self.pending_jump and self.pending_jump[0] != index:
+            self.pending_jump = None
+            
+        chapter = self.chapters[index]
+        
+        # 与当前章节属于同一文档且已渲染完成时，只需在现有内容中跳转到锚点
+        if (self.loading_chapter is None and self.current_content is not None
+                and self.chapters[self.current_chapter_index]["document"] == chapter["document"]):
+            self.update_navigation(index)
+            self.status_label.config(text=chapter["title"])
+            if self.pending_jump is None:
+                self.pending_jump = (index, self.current_content["anchors"].get(chapter["anchor"], 0), 0)
+            self.apply_pending_jump()
+            return
+            
         self.loading_chapter = index
+        
+        # 查找索引与章节内容对应，切换章节后重新建立
+        self.current_content = None
+        self.find_index = None
+        self.find_matches = []
+        self.find_current = -1
             
         # 清除文本区域
         self.clear_text_area()
         self.text_area.config(state=tk.NORMAL)
         
         # 更新UI状态
-        self.page_label.config(text=f"章节: {index+1}/{len(self.chapters)}")
-        self.chapter_combo.current(index)
-        self.current_chapter_index = index
-        
-        # 更新翻页按钮状态
-        self.prev_button.config(state=tk.NORMAL if index > 0 else tk.DISABLED)
-        self.next_button.config(state=tk.NORMAL if index < len(self.chapters) - 1 else tk.DISABLED)
+        self.update_navigation(index)
         
         # 获取章节数据
-        chapter = self.chapters[index]
-        path = chapter["path"]
         title = chapter["title"]
         
         # 显示章节标题
         self.text_area.insert(tk.END, f"\n{title}\n", "chapter_title")
         self.text_area.insert(tk.END, "\n" + "=" * len(title) + "\n\n", "chapter_title")
         
-        # 在后台线程中处理章节内容
-        self.executor.submit(self.process_chapter_content, index, chapter)
+        # 标记正文起点，正文偏移量都相对于此位置
+        self.text_area.mark_set("content_start", "end-1c")
+        self.text_area.mark_gravity("content_start", tk.LEFT)
+        
+        # 已预取到内存的文档直接显示，否则等待后台线程处理
+        generation = self.render_generation
+        document = chapter["document"]
+        cached_content = self.chapter_cache.get((self.book_hash, document))
+        future = self.chapter_futures.get(document)
+        prefetched = cached_content is not None or (future is not None and not future.cancelled())
+        if cached_content is not None:
+            self.insert_cached_content(cached_content)
+        else:
+            if future is None or future.cancelled():
+                future = self.executor.submit(self.prepare_chapter, self.book_hash, self.parse_cache_key,
+                                              self.book_source, document, self.chapters[document])
+                self.chapter_futures[document] = future
+            future.add_done_callback(lambda f: self.dispatcher.post(self.on_chapter_ready, f, generation))
+        
+        # 记录预取命中情况
+        self.prefetch_stats["hits" if prefetched else "misses"] += 1
+        self.status_label.config(text=f"{title} - {'预取命中' if prefetched else '未预取'}")
+        
+        # 预取相邻章节
+        self.schedule_prefetch(index)
         
         # 滚动到顶部
         self.text_area.yview_moveto(0)
+
+    def update_navigation(self, index):
+        """更新章节下拉菜单、页码和翻页按钮"""
+        self.page_label.config(text=f"章节: {index+1}/{len(self.chapters)}")
+        self.chapter_combo.current(index)
+        self.current_chapter_index = index
         
-    def process_chapter_content(self, index, chapter):
-        """在后台线程中处理章节内容"""
-        if index != self.current_chapter_index:
+        # 更新翻页按钮状态
+        self.prev_button.config(state=tk.NORMAL if index > 0 else tk.DISABLED)
+        self.next_button.config(state=tk.NORMAL if index < len(self.chapters) - 1 else tk.DISABLED)
+
+    def on_chapter_ready(self, future, generation):
+        """后台章节处理完成后在UI线程中显示"""
+        # 章节已切换，丢弃结果
+        if generation != self.render_generation:
             return
-            
-        # 检查缓存
-        cache_key = f"{self.book_title}_{index}"
-        if cache_key in self.chapter_cache:
-            # 使用缓存内容
-            cached_content = self.chapter_cache[cache_key]
-            self.root.after(0, lambda: self.insert_cached_content(cached_content))
+        try:
+            cached_content = future.result()
+        except Exception as e:
+            self.loading_chapter = None
+            self.status_label.config(text=f"错误: {str(e)}")
             return
+        self.insert_cached_content(cached_content)
+
+    def schedule_prefetch(self, index):
+        """在线程池中预取当前章节前后的文档，并取消不再需要的预取任务"""
+        current = self.chapters[index]["document"]
+        wanted = {current}
+        for step in (1, -1):
+            # 跳过与当前章节共用文档的章节
+            found = 0
+            neighbor = index + step
+            while 0 <= neighbor < len(self.chapters) and found < self.prefetch_depth:
+                document = self.chapters[neighbor]["document"]
+                if document not in wanted:
+                    wanted.add(document)
+                    found += 1
+                neighbor += step
+        
+        # 取消过期的预取（例如通过章节下拉菜单跳转后）
+        for other, future in list(self.chapter_futures.items()):
+            if other not in wanted:
+                future.cancel()
+                del self.chapter_futures[other]
+            elif future.done():
+                del self.chapter_futures[other]
+        
+        for document in sorted(wanted - {current}, key=lambda d: abs(d - index)):
+            if document in self.chapter_futures or (self.book_hash, document) in self.chapter_cache:
+                continue
+            self.chapter_futures[document] = self.executor.submit(
+                self.prepare_chapter, self.book_hash, self.parse_cache_key, self.book_source,
+                document, self.chapters[document])
+
+    def prepare_chapter(self, book_hash, parse_cache_key, source, document, chapter):
+        """在后台线程中准备文档内容：依次查找内存缓存、磁盘缓存，最后解析
+        
+        书籍相关的状态都通过参数传入，切换书籍期间也不会读取或写入其他书籍的缓存
+        """
+        # 已切换到其他书籍
+        if book_hash != self.book_hash:
+            return None
+            
+        cache_key = (book_hash, document)
+        cached_content = self.chapter_cache.get(cache_key)
+        if cached_content is not None:
+            return cached_content
             
-        # 处理章节内容
-        soup = chapter["soup"]
+        cached_content = self.parse_cache.load_chapter(parse_cache_key, document)
+        if cached_content is None:
+            cached_content = self.build_chapter_content(source, chapter, book_hash)
+            # 写入磁盘解析缓存
+            self.executor.submit(self.parse_cache.save_chapter, parse_cache_key, document, cached_content)
+        
+        self.chapter_cache.put(cache_key, cached_content, estimate_runs_size(cached_content["runs"]))
+        return cached_content
+        
+    def build_chapter_content(self, source, chapter, book_hash):
+        """解析章节HTML并展开为渲染片段"""
+        content = source.get_item(chapter).get_content()
+        soup = BeautifulSoup(content, 'html.parser')
         path = chapter["path"]
         
         # 创建章节目录
-        toc = self.create_chapter_toc(soup)
+        toc = self.create_chapter_toc(soup, path, book_hash)
         
         # 移除不需要的元素
         for element in soup(['script', 'style', 'header', 'footer', 'nav', 'aside', 'svg']):
@@ -1138,49 +3276,110 @@ class EPubReaderApp:
         # 处理正文内容
         body = soup.body if soup.body else soup
         
-        # 构建缓存内容
-        cached_content = {
+        # 将章节目录和正文展开为扁平的 (文本, 标签) 片段列表
+        builder = RenderRunBuilder()
+        if toc:
+            builder.text("本章目录:\n\n", "subheading")
+            for level, title in toc:
+                indent = "    " * (level - 1)
+                builder.text(f"{indent}- {title}\n", "normal")
+            builder.text("\n" + "-" * 40 + "\n\n", ())
+        self.build_render_runs(body, builder)
+        
+        # 添加章节结束标记
+        builder.text("\n\n" + "-" * 40 + "\n\n", ())
+        runs = builder.finish()
+        
+        # 构建缓存内容（只保存渲染片段、对应的纯文本和锚点位置，不再保留BeautifulSoup树）
+        return {
             "toc": toc,
-            "body": body,
+            "runs": runs,
+            "text": runs_plain_text(runs),
+            "anchors": builder.anchors,
             "path": path
         }
         
-        # 存储到缓存
-        self.chapter_cache[cache_key] = cached_content
-        
-        # 更新UI
-        self.root.after(0, lambda: self.insert_cached_content(cached_content))
-        
     def insert_cached_content(self, cached_content):
-        """将缓存内容插入文本区域"""
+        """将缓存内容插入文本区域 - 先显示首屏，其余部分分批追加"""
         if not cached_content:
             return
-            
-        toc = cached_content["toc"]
-        body = cached_content["body"]
-        path = cached_content["path"]
+        self.current_content = cached_content
         
-        # 显示章节目录
-        if toc:
-            self.text_area.insert(tk.END, "本章目录:\n\n", "subheading")
-            for level, title in toc:
-                indent = "    " * (level - 1)
-                self.text_area.insert(tk.END, f"{indent}- {title}\n", "normal")
-            self.text_area.insert(tk.END, "\n" + "-" * 40 + "\n\n")
-        
-        # 处理正文内容
-        self.process_element(body, path)
+        # 目录项指向文档中的锚点时，渲染完成后跳转到该位置
+        index = self.current_chapter_index
+        anchor = self.chapters[index]["anchor"]
+        if anchor in cached_content["anchors"] and self.pending_jump is None:
+            self.pending_jump = (index, cached_content["anchors"][anchor], 0)
+            
+        job = {
+            "runs": cached_content["runs"],
+            "path": cached_content["path"],
+            "run": 0,  # 当前片段序号
+            "offset": 0,  # 当前片段内已插入的字符数
+            "generation": self.render_generation
+        }
+        self.render_runs_batch(job, RENDER_FIRST_BATCH_CHARS)
+
+    def render_runs_batch(self, job, char_limit):
+        """在时间预算内插入一批渲染片段，未完成时通过after继续"""
+        # 章节已切换，停止渲染
+        if job["generation"] != self.render_generation:
+            return
+            
+        runs = job["runs"]
+        deadline = time.perf_counter() + RENDER_TIME_BUDGET
+        inserted = 0
+        args = []
+        batch_chars = 0
+        self.text_area.config(state=tk.NORMAL)
         
-        # 添加章节结束标记
-        self.text_area.insert(tk.END, "\n\n" + "-" * 40 + "\n\n")
+        # 连续的文本片段合并为一次insert调用，只有图片需要单独处理
+        while job["run"] < len(runs) and inserted < char_limit and time.perf_counter() < deadline:
+            text, tag = runs[job["run"]]
+            if tag == IMAGE_RUN:
+                if args:
+                    self.text_area.insert(tk.END, *args)
+                    args = []
+                    batch_chars = 0
+                self.insert_image(text, job["path"])
+                job["run"] += 1
+                inserted += 1
+                continue
+                
+            # 过长的片段拆分插入，保证每次insert的耗时可控
+            start = job["offset"]
+            chunk = text[start:start + RENDER_BATCH_CHARS - batch_chars]
+            args.extend((chunk, tag))
+            batch_chars += len(chunk)
+            inserted += len(chunk)
+            if start + len(chunk) >= len(text):
+                job["run"] += 1
+                job["offset"] = 0
+            else:
+                job["offset"] = start + len(chunk)
+            if batch_chars >= RENDER_BATCH_CHARS:
+                self.text_area.insert(tk.END, *args)
+                args = []
+                batch_chars = 0
+        if args:
+            self.text_area.insert(tk.END, *args)
         
         # 禁用文本区域
         self.text_area.config(state=tk.DISABLED)
         
-        # 重置加载状态
-        self.loading_chapter = None
+        if job["run"] < len(runs):
+            # 让出事件循环处理滚动等输入后继续
+            self.root.after(1, self.render_runs_batch, job, float("inf"))
+        else:
+            # 重置加载状态
+            self.loading_chapter = None
+            if self.pending_jump:
+                self.apply_pending_jump()
+            if self.find_visible:
+                self.update_find(force=True)
 
-    def create_chapter_toc(self, soup):
+    @memoize(maxsize=256, key=lambda self, soup, path, book_hash: (book_hash, path))
+    def create_chapter_toc(self, soup, path, book_hash):
         """创建章节内目录 - 优化性能"""
         toc = []
         headings = soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
@@ -1193,117 +3392,252 @@ class EPubReaderApp:
         
         return toc if toc else None
 
-    def process_element(self, element, chapter_path):
-        """递归处理HTML元素 - 优化性能"""
+    def build_render_runs(self, element, builder):
+        """递归展开HTML元素为渲染片段 - 纯Python，不访问Tk控件"""
         if isinstance(element, str):
             # 处理文本节点
             text = html.unescape(element.strip())
             if text:
-                self.text_area.insert(tk.END, text + " ", "normal")
+                builder.text(text + " ", "normal")
         elif hasattr(element, 'children'):
+            # 记录锚点位置
+            anchor = element.get('id') or (element.get('name') if element.name == 'a' else None)
+            if anchor:
+                builder.anchor(anchor)
             # 处理元素节点
             if element.name == 'img' and 'src' in element.attrs:
-                self.insert_image(element['src'], chapter_path)
+                builder.image(element['src'])
             elif element.name == 'p':
-                self.text_area.insert(tk.END, '\n\n', "normal")
+                builder.text('\n\n', "normal")
                 for child in element.children:
-                    self.process_element(child, chapter_path)
-                self.text_area.insert(tk.END, '\n', "normal")
+                    self.build_render_runs(child, builder)
+                builder.text('\n', "normal")
             elif element.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                level = int(element.name[1])
-                self.text_area.insert(tk.END, '\n\n', "normal")
-                self.text_area.insert(tk.END, element.get_text().strip() + '\n', "subheading")
-                self.text_area.insert(tk.END, '-' * len(element.get_text().strip()) + '\n\n', "normal")
+                heading = element.get_text().strip()
+                builder.text('\n\n', "normal")
+                builder.text(heading + '\n', "subheading")
+                builder.text('-' * len(heading) + '\n\n', "normal")
             elif element.name == 'br':
-                self.text_area.insert(tk.END, '\n', "normal")
+                builder.text('\n', "normal")
             elif element.name == 'hr':
-                self.text_area.insert(tk.END, '\n' + '-' * 40 + '\n', "normal")
+                builder.text('\n' + '-' * 40 + '\n', "normal")
             elif element.name == 'blockquote':
-                self.text_area.insert(tk.END, '\n  ', "quote")
+                builder.text('\n  ', "quote")
                 for child in element.children:
-                    self.process_element(child, chapter_path)
-                self.text_area.insert(tk.END, '\n\n', "quote")
+                    self.build_render_runs(child, builder)
+                builder.text('\n\n', "quote")
             elif element.name == 'div' or element.name == 'section':
-                self.text_area.insert(tk.END, '\n', "normal")
+                builder.text('\n', "normal")
                 for child in element.children:
-                    self.process_element(child, chapter_path)
-                self.text_area.insert(tk.END, '\n', "normal")
+                    self.build_render_runs(child, builder)
+                builder.text('\n', "normal")
             elif element.name == 'li':
-                self.text_area.insert(tk.END, '\n• ', "normal")
+                builder.text('\n• ', "normal")
                 for child in element.children:
-                    self.process_element(child, chapter_path)
+                    self.build_render_runs(child, builder)
             elif element.name == 'a' and 'href' in element.attrs:
                 # 处理超链接但不显示URL
                 for child in element.children:
-                    self.process_element(child, chapter_path)
+                    self.build_render_runs(child, builder)
             else:
                 # 默认处理：递归处理所有子元素
                 for child in element.children:
-                    self.process_element(child, chapter_path)
+                    self.build_render_runs(child, builder)
         elif element is not None:
             # 处理其他类型的节点
-            self.text_area.insert(tk.END, str(element), "normal")
+            builder.text(str(element), "normal")
 
     def insert_image(self, src, chapter_dir):
-        """插入图片到文本区域 - 使用缓存优化性能"""
+        """插入图片到文本区域 - 解码和缩放在线程池中进行，先显示占位符"""
+        # 解析图片路径
+        image_path = self.resolve_image_path(src, chapter_dir)
+        
+        # 获取当前文本区域宽度
+        text_width = self.text_area.winfo_width() - 50
+        if text_width < 100:
+            text_width = 600
+        
+        # 检查缓存
+        cached_image = self.image_cache.get_photo(self.book_hash, image_path, text_width)
+        if cached_image:
+            # 使用缓存的图片
+            self.text_area.image_create(tk.END, image=cached_image)
+            self.text_area.tag_add("center", "insert-1c", "insert")
+            self.text_area.insert(tk.END, IMAGE_SUFFIX, "normal")
+            return
+        
+        # 插入单字符占位符，图片准备好后再替换
+        self.image_counter += 1
+        placeholder_tag = f"image_pending_{self.image_counter}"
+        self.text_area.insert(tk.END, IMAGE_PLACEHOLDER, ("center", "image_placeholder", placeholder_tag))
+        self.text_area.insert(tk.END, IMAGE_SUFFIX, "normal")
+        
+        # 在线程池中解码和缩放图片，书籍状态通过参数传入，切换书籍后不会读到其他书籍的图片
+        generation = self.render_generation
+        book_hash = self.book_hash
+        future = self.executor.submit(
+            self.prepare_image, self.image_resources, book_hash, image_path, src, text_width)
+        future.add_done_callback(lambda f: self.dispatcher.post(
+            self.on_image_ready, f, generation, placeholder_tag, book_hash, image_path, text_width))
+
+    def prepare_image(self, resources, book_hash, image_path, src, text_width):
+        """在后台线程中解码并缩放图片，返回PIL图像"""
+        # 已解码的原图可在不同宽度间复用
+        image = self.image_cache.get_source(book_hash, image_path)
+        if image is None:
+            image = self.decode_image(resources, image_path, src)
+            self.image_cache.put_source(book_hash, image_path, image)
+        
+        # 调整图片大小
+        width, height = image.size
+        if width > text_width:
+            ratio = text_width / width
+            new_size = (int(width * ratio), int(height * ratio))
+            image = image.resize(new_size, Image.LANCZOS)
+        
+        return image
+
+    def decode_image(self, resources, image_path, src):
+        """查找并解码图片资源"""
+        image_data = None
+        if image_path in resources:
+            image_data = resources.read(image_path)
+        else:
+            filename = os.path.basename(image_path)
+            if filename in resources:
+                image_data = resources.read(filename)
+            elif src in resources:
+                image_data = resources.read(src)
+        
+        if not image_data:
+            raise FileNotFoundError(image_path)
+        
+        image = Image.open(io.BytesIO(image_data))
+        image.load()
+        return image
+
+    def on_image_ready(self, future, generation, placeholder_tag, book_hash, image_path, text_width):
+        """图片准备完成后在UI线程中替换占位符"""
+        ranges = self.text_area.tag_ranges(placeholder_tag)
+        self.text_area.tag_delete(placeholder_tag)
+        
+        # 章节已切换，丢弃结果
+        if generation != self.render_generation or not ranges:
+            return
+        
+        previous_state = self.text_area.cget("state")
+        self.text_area.config(state=tk.NORMAL)
+        index = ranges[0]
+        self.text_area.delete(index, ranges[1])
+        
         try:
-            # 解析图片路径
-            image_path = self.resolve_image_path(src, chapter_dir)
-            
-            # 获取当前文本区域宽度
-            text_width = self.text_area.winfo_width() - 50
-            if text_width < 100:
-                text_width = 600
-            
-            # 检查缓存
-            cached_image = self.image_cache.get(image_path, chapter_dir, text_width)
-            if cached_image:
-                # 使用缓存的图片
-                self.text_area.image_create(tk.END, image=cached_image)
-                self.text_area.tag_add("center", "insert-1c", "insert")
-                self.text_area.insert(tk.END, '\n\n', "normal")
-                return
-            
-            # 查找图片资源
-            image_data = None
-            if image_path in self.image_resources:
-                image_data = self.image_resources[image_path]
-            else:
-                filename = os.path.basename(image_path)
-                if filename in self.image_resources:
-                    image_data = self.image_resources[filename]
-                elif src in self.image_resources:
-                    image_data = self.image_resources[src]
-            
-            if not image_data:
-                self.text_area.insert(tk.END, f"\n[图片未找到: {image_path}]\n\n", "normal")
-                return
-            
-            # 处理图片
-            image = Image.open(io.BytesIO(image_data))
-            
-            # 调整图片大小
-            width, height = image.size
-            if width > text_width:
-                ratio = text_width / width
-                new_size = (int(width * ratio), int(height * ratio))
-                image = image.resize(new_size, Image.LANCZOS)
+            image = future.result()
             
             # 显示图片
             photo = ImageTk.PhotoImage(image)
             self.image_references.append(photo)
             
             # 添加到缓存
-            self.image_cache.put(image_path, photo, chapter_dir, text_width)
+            self.image_cache.put_photo(book_hash, image_path, photo, text_width)
             
             # 居中显示
-            self.text_area.image_create(tk.END, image=photo)
-            self.text_area.tag_add("center", "insert-1c", "insert")
-            self.text_area.insert(tk.END, '\n\n', "normal")
-            
+            self.text_area.image_create(index, image=photo)
+            self.text_area.tag_add("center", index)
+        except FileNotFoundError:
+            self.insert_image_error(index, f"\n[图片未找到: {image_path}]")
         except Exception as e:
-            self.text_area.insert(tk.END, f"\n[图片错误: {str(e)}]\n\n", "normal")
+            self.insert_image_error(index, f"\n[图片错误: {str(e)}]")
+        
+        self.text_area.config(state=previous_state)
+
+    def insert_image_error(self, index, message):
+        """用错误提示替换图片占位符，并记录正文偏移量的变化"""
+        count = self.text_area.count("content_start", index, "chars")
+        self.offset_shifts.append((count[0] if count else 0, len(message) - 1))
+        self.text_area.insert(index, message, "normal")
+
+    def body_index(self, offset):
+        """正文偏移量转换为文本区域索引"""
+        shift = sum(delta for position, delta in self.offset_shifts if position < offset)
+        return f"content_start + {offset + shift} chars"
+
+    def show_find_bar(self, event=None):
+        """显示章节内查找栏"""
+        if not self.find_visible:
+            self.find_frame.pack(fill=tk.X, pady=(0, 5), before=self.text_frame)
+            self.find_visible = True
+        self.find_entry.focus_set()
+        self.find_entry.select_range(0, tk.END)
+        self.update_find(force=True)
+
+    def hide_find_bar(self, event=None):
+        """隐藏查找栏并清除高亮"""
+        self.find_frame.pack_forget()
+        self.find_visible = False
+        self.find_matches = []
+        self.find_current = -1
+        self.text_area.tag_remove("find_hit", "1.0", tk.END)
+        self.text_area.tag_remove("find_current", "1.0", tk.END)
+        self.text_area.focus_set()
+        return "break"
+
+    def update_find(self, event=None, force=False):
+        """按输入内容查找 - 继续输入时只在上一次结果中筛选"""
+        query = self.find_entry.get()
+        if query == self.find_query and self.find_index is not None and not force:
+            return
+        self.find_query = query
+        if self.current_content is None:
+            return
+        if self.find_index is None:
+            self.find_index = TextFindIndex(self.current_content["text"])
+            
+        # 保持在上一个选中位置附近
+        previous = self.find_matches[self.find_current] if 0 <= self.find_current < len(self.find_matches) else 0
+        self.find_matches = self.find_index.find(query) if query else []
+        self.find_current = bisect.bisect_left(self.find_matches, previous) if self.find_matches else -1
+        if self.find_current >= len(self.find_matches):
+            self.find_current = 0
+        self.highlight_find_matches()
+
+    def highlight_find_matches(self):
+        """一次tag_add调用高亮全部匹配"""
+        self.text_area.tag_remove("find_hit", "1.0", tk.END)
+        self.text_area.tag_remove("find_current", "1.0", tk.END)
+        if not self.find_matches:
+            self.find_label.config(text="无匹配" if self.find_query else "")
+            return
+            
+        length = len(self.find_query)
+        ranges = []
+        for position in self.find_matches:
+            ranges.extend((self.body_index(position), self.body_index(position + length)))
+        self.text_area.tag_add("find_hit", *ranges)
+        self.select_find_match(self.find_current)
+
+    def select_find_match(self, index):
+        """选中第index个匹配并滚动到该位置"""
+        self.find_current = index
+        position = self.find_matches[index]
+        start = self.body_index(position)
+        self.text_area.tag_remove("find_current", "1.0", tk.END)
+        self.text_area.tag_add("find_current", start, self.body_index(position + len(self.find_query)))
+        self.text_area.see(start)
+        self.find_label.config(text=f"{index + 1}/{len(self.find_matches)}")
+
+    def find_next(self, event=None):
+        """跳转到下一个匹配"""
+        if self.find_matches:
+            self.select_find_match((self.find_current + 1) % len(self.find_matches))
+        return "break"
+
+    def find_previous(self, event=None):
+        """跳转到上一个匹配"""
+        if self.find_matches:
+            self.select_find_match((self.find_current - 1) % len(self.find_matches))
+        return "break"
 
+    @memoize(maxsize=1024)
     def resolve_image_path(self, src, chapter_dir):
         """解析图片路径 - 优化性能"""
         if src.startswith('/'):
@@ -1334,6 +3668,8 @@ class EPubReaderApp:
     def __del__(self):
         """析构函数，清理资源"""
         self.executor.shutdown(wait=False)
+        self.index_executor.shutdown(wait=False)
+        self.thumbnail_executor.shutdown(wait=False)
         gc.collect()
 
 if __name__ == "__main__":